@@ -1,12 +1,44 @@
 #!/usr/bin/env python3
+"""
+Make specs from bandcamp pages.
 
+    bandcamp2spec.py URL... [-o DIR] [-j N] [--force] [--refresh]
+
+Each URL can be an album, a track, or an artist's discography (their /music
+page), which stands for every release on it. Pages are fetched concurrently,
+and cached in CACHEDIR/bandcamp for --max-age days. Each release is written
+to DIR (spec/ by default) as <artist>-<name>.yaml, or to stdout with `-o -`.
+"""
+
+from lyrebird.fetch import CACHEDIR
+from lyrebird.lrc import Lrc
+from lyrebird.net import HTTP
 from lyrebird.schema import Album
 from lyrebird.schema import Track
-import datetime as dt
+from lyrebird.speccache import parse_spec
+from pathlib import Path
 import argparse
+import asyncio
 import bs4
-import requests
+import datetime as dt
+import hashlib
+import json
+import os
 import re
+import sys
+import time
+import typing as t
+import urllib.parse
+
+PAGE_CACHE_DIR = CACHEDIR / "bandcamp"
+
+try:
+    import lxml  # noqa: F401
+
+    # much faster than html.parser, if it's there
+    PARSER = "lxml"
+except ImportError:
+    PARSER = "html.parser"
 
 
 def select(tag: bs4.Tag, query: str) -> bs4.Tag:
@@ -15,21 +47,71 @@ def select(tag: bs4.Tag, query: str) -> bs4.Tag:
     return matches[0]
 
 
-def scrape_track(track: bs4.Tag) -> Track:
-    title = select(track, ".track-title").get_text().strip()
-    time = select(track, ".time").get_text().strip()
-    mm, ss = time.split(":")
+def parse_time(text: str) -> float:
+    """
+    Parse [hh:]mm:ss into seconds.
+    """
+    seconds = 0.0
+    for part in text.strip().split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
 
-    return Track(
-        title=title,
-    )
 
+async def fetch_page(url: str, max_age: dt.timedelta) -> str:
+    """
+    Fetch a page, or use the cached copy if it's new enough.
+    """
+    path = PAGE_CACHE_DIR / f"{hashlib.sha256(url.encode()).hexdigest()}.html"
+    try:
+        if time.time() - path.stat().st_mtime < max_age.total_seconds():
+            return path.read_text()
+    except OSError:
+        pass
 
-def scrape_page(url: str) -> Album:
-    r = requests.get(url)
+    r = await HTTP.get(url)
     r.raise_for_status()
-    soup = bs4.BeautifulSoup(r.text, "html.parser")
 
+    PAGE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(r.text)
+    os.replace(tmp, path)
+    return r.text
+
+
+def discography(url: str, soup: bs4.BeautifulSoup) -> list[str] | None:
+    """
+    The releases on a discography page, or None if it isn't one.
+    """
+    grid = soup.css.select_one("#music-grid")
+    if grid is None or soup.css.select_one("h2.trackTitle") is not None:
+        return None
+
+    links = [a["href"] for a in grid.css.select("li a[href]")]
+    # past the first few, the rest are only given as JSON, to be shown later
+    items = grid.get("data-client-items")
+    if isinstance(items, str):
+        links.extend(item["page_url"] for item in json.loads(items))
+
+    urls: list[str] = []
+    for link in links:
+        assert isinstance(link, str)
+        full = urllib.parse.urljoin(url, link).split("?")[0]
+        if full not in urls:
+            urls.append(full)
+    return urls
+
+
+def scrape_track(track: bs4.Tag) -> Track:
+    title = select(track, ".track-title").get_text().strip()
+    time = track.css.select_one(".time")
+
+    # noted in the spec, to compare with what's downloaded
+    text = time.get_text().strip() if time else ""
+    lrc = Lrc(duration=parse_time(text)) if text else Lrc()
+    return Track(title=title, lrc=lrc)
+
+
+def scrape_page(url: str, soup: bs4.BeautifulSoup) -> Album:
     title = select(soup, "h2.trackTitle").get_text().strip()
     artist = select(soup, "#band-name-location > .title").get_text().strip()
     cover = select(soup, "#tralbumArt > .popupImage")["href"]
@@ -40,7 +122,15 @@ def scrape_page(url: str) -> Album:
     assert m
     date = dt.datetime.strptime(m.group(1), "%B %d, %Y").date()
 
-    tracks = soup.css.select(".track_row_view")
+    rows = soup.css.select(".track_row_view")
+    if rows:
+        tracks = tuple(scrape_track(t) for t in rows)
+    else:
+        # a track page, which is a release of just that track
+        time = soup.css.select_one(".time_total")
+        text = time.get_text().strip() if time else ""
+        lrc = Lrc(duration=parse_time(text)) if text else Lrc()
+        tracks = (Track(title=title, lrc=lrc),)
 
     return Album(
         url=url,
@@ -48,41 +138,147 @@ def scrape_page(url: str) -> Album:
         album_artist=artist,
         date=date,
         cover=cover,
-        tracks=tuple(scrape_track(t) for t in tracks),
+        tracks=tracks,
     )
-    raise ValueError()
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("url")
-    args = parser.parse_args()
+def q(s: str) -> str:
+    """
+    Quote a string for yaml. JSON strings are also valid yaml ones.
+    """
+    return json.dumps(s, ensure_ascii=False)
 
-    album = scrape_page(args.url)
 
-    print(
-        f"""
-# fetching info
-url: "{album.url}"
+def to_yaml(album: Album) -> str:
+    assert album.url and album.album and album.date
+    lines = [
+        "# fetching info",
+        f"url: {q(album.url)}",
+        "",
+        "lrc:",
+        "  expect: ~",
+        "",
+        "# common metadata",
+        f"album: {q(album.album)}",
+        f"album_artist: {q(album.album_artist)}",
+        f"date: {album.date:%Y-%m-%d}",
+        f"cover: {q(album.cover) if album.cover else '~'}",
+        "",
+        "tracks:",
+    ]
+    for track in album.tracks:
+        line = f"- title: {q(track.title)}"
+        # Only as a note: the duration of what's downloaded is more accurate,
+        # and setting this would stop it from being used.
+        if "duration" in track.lrc.model_fields_set:
+            line += f"  # {fmt_duration(track.lrc.duration)}"
+        lines.append(line)
+    text = "\n".join(lines) + "\n"
+
+    # make sure it means what it should
+    parsed = parse_spec(text.encode())
+    exclude: t.Any = {"lrc": True, "tracks": {"__all__": {"lrc"}}}
+    assert parsed.model_dump(exclude=exclude) == album.model_dump(exclude=exclude)
+    return text
+
+
+def fmt_duration(seconds: float) -> str:
+    m, s = divmod(round(seconds), 60)
+    return f"{m}:{s:02}"
+
+
+def spec_name(url: str) -> str:
+    """
+    Name a spec like the others: the artist's subdomain (or site), and then
+    the release's.
+    """
+    parts = urllib.parse.urlsplit(url)
+    host = parts.hostname or ""
+    artist = host.removeprefix("www.").split(".")[0]
+    release = parts.path.rstrip("/").rsplit("/", 1)[-1]
+    return f"{artist}-{release}"
 
-lrc:
-  expect: ~
 
-# common metadata
-album: "{album.album}"
-album_artist: "{album.album_artist}"
-date: {album.date:%Y-%m-%d}
-cover: "{album.cover}"
+async def run(args: argparse.Namespace) -> bool:
+    max_age = dt.timedelta(days=0 if args.refresh else args.max_age)
 
-tracks:
-    """.strip()
+    async def load(url: str) -> bs4.BeautifulSoup:
+        text = await fetch_page(url, max_age)
+        return await asyncio.to_thread(bs4.BeautifulSoup, text, PARSER)
+
+    async def scrape(url: str) -> Album:
+        return scrape_page(url, await load(url))
+
+    ok = True
+    written: set[Path] = set()
+    releases: list[str] = []
+    soups = await asyncio.gather(
+        *(load(url) for url in args.url), return_exceptions=True
     )
-    for track in album.tracks:
-        print(
-            f"""
-- title: {track.title}
-        """.strip()
-        )
+    for url, soup in zip(args.url, soups):
+        if isinstance(soup, BaseException):
+            print(f"{url}: {soup!r}", file=sys.stderr)
+            ok = False
+            continue
+        urls = discography(url, soup)
+        for release in urls if urls is not None else [url]:
+            if release not in releases:
+                releases.append(release)
+
+    albums = await asyncio.gather(
+        *(scrape(url) for url in releases), return_exceptions=True
+    )
+    for url, album in zip(releases, albums):
+        if isinstance(album, BaseException):
+            print(f"{url}: {album!r}", file=sys.stderr)
+            ok = False
+            continue
+
+        text = to_yaml(album)
+        if args.out == "-":
+            print("---")
+            print(text, end="")
+            continue
+
+        path = Path(args.out) / f"{spec_name(url)}.yaml"
+        if path in written:
+            print(f"{url}: {path} was already written for another", file=sys.stderr)
+            ok = False
+            continue
+        written.add(path)
+        if path.exists() and not args.force:
+            print(f"{path} exists, skipping", file=sys.stderr)
+            continue
+        path.write_text(text)
+        print(f"{url} -> {path}", file=sys.stderr)
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", nargs="+")
+    parser.add_argument(
+        "--out", "-o", default="spec", help="where to write specs, or - for stdout"
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=4, help="pages to fetch at once"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="overwrite specs which already exist"
+    )
+    parser.add_argument("--refresh", action="store_true", help="ignore cached pages")
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        metavar="DAYS",
+        default=7,
+        help="how long to keep pages cached",
+    )
+    args = parser.parse_args()
+
+    HTTP.per_host = args.jobs
+    sys.exit(0 if asyncio.run(run(args)) else 1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,261 @@
+"""
+Benchmark the whole album pipeline, offline.
+
+    python bench/pipeline.py [--albums N] [--tracks N] [--jobs N]
+                             [--latency MS] [--passes N] [--keep DIR]
+
+This generates silent mp3s to stand in for downloads (served through file://
+urls, so there's no yt-dlp or ffmpeg involved), and synthetic specs for them.
+A local HTTP server stands in for lrclib.net (/get, /get/{id} and /search)
+and serves the covers, optionally with some latency. Everything, including
+the caches, lives in a temporary directory.
+
+Each pass runs every album through process_album, like `lyrebird -j N`
+would, and reports tracks/sec, per-stage p50/p95 times and peak RSS. Later
+passes run with the on-disk caches warm (and --incremental), like re-running
+over a library would; what's only remembered in memory is forgotten between
+passes.
+"""
+
+from pathlib import Path
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import http.server
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import typing as t
+import urllib.parse
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# frames are MPEG-1 layer III, 128kbps, 44.1kHz, joint stereo, no CRC
+FRAME_SAMPLES = 1152
+SAMPLE_RATE = 44100
+
+
+def silent_mp3(seconds: float) -> bytes:
+    """
+    A CBR mp3 of silence: frames with all-zero side info and main data.
+    """
+    # 128kbps at 44.1kHz is 417.96 bytes per frame, so some are padded by one
+    size, rem = divmod(FRAME_SAMPLES // 8 * 128000, SAMPLE_RATE)
+    frames = []
+    acc = 0
+    for _ in range(int(seconds * SAMPLE_RATE / FRAME_SAMPLES)):
+        acc += rem
+        padded = acc >= SAMPLE_RATE
+        acc -= SAMPLE_RATE * padded
+        header = bytes([0xFF, 0xFB, 0x92 if padded else 0x90, 0x64])
+        frames.append(header + bytes(size - 4 + padded))
+    return b"".join(frames)
+
+
+def lyrics(seconds: float) -> str:
+    lines = [
+        f"[{int(s) // 60:02}:{int(s) % 60:02}.{int(s * 100) % 100:02}]line {i}"
+        for i, s in enumerate(x * 2.5 for x in range(int(seconds / 2.5)))
+    ]
+    return "\n".join(lines + [f"[{int(seconds) // 60:02}:{int(seconds) % 60:02}.00]"])
+
+
+class Stub(http.server.BaseHTTPRequestHandler):
+    """
+    Stands in for lrclib.net and cover hosts. Tracks titled "exact ..." are
+    found by /get, "search ..." only by /search, and anything else not at
+    all.
+    """
+
+    latency = 0.0
+
+    def do_GET(self) -> None:
+        time.sleep(self.latency)
+        url = urllib.parse.urlsplit(self.path)
+        q = dict(urllib.parse.parse_qsl(url.query))
+
+        def record(id: int, name: str, duration: float) -> dict[str, t.Any]:
+            return {
+                "id": id,
+                "trackName": name,
+                "artistName": q.get("artist_name", "Artist"),
+                "albumName": q.get("album_name", "Album"),
+                "duration": duration,
+                "instrumental": False,
+                "plainLyrics": None,
+                "syncedLyrics": lyrics(duration),
+            }
+
+        name = q.get("track_name", "")
+        duration = float(name.rsplit(" ", 1)[-1]) if name else 0.0
+        if url.path == "/api/get" and name.startswith("exact "):
+            self.send(200, record(1, name, duration))
+        elif url.path.startswith("/api/get/"):
+            self.send(200, record(int(url.path.rsplit("/", 1)[1]), "by id", 30.0))
+        elif url.path == "/api/search" and name.startswith("search "):
+            # a cover version first, to make ranking do some work
+            self.send(
+                200,
+                [
+                    record(3, f"{name} (cover)", duration + 20),
+                    record(2, name, duration),
+                ],
+            )
+        elif url.path == "/api/search":
+            self.send(200, [])
+        elif url.path.startswith("/cover/"):
+            if self.headers.get("if-none-match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = b"\xff\xd8\xff\xe0" + os.urandom(256 * 1024)
+            self.send(200, body, "image/jpeg")
+        else:
+            self.send(404, {"code": 404})
+
+    def send(self, status: int, body: t.Any, ctype: str = "application/json") -> None:
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("content-type", ctype)
+        self.send_header("content-length", str(len(data)))
+        self.send_header("etag", '"v1"')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args: t.Any) -> None:
+        pass
+
+
+def make_specs(
+    dir: Path, albums: int, tracks: int, base: str
+) -> list[dict[str, t.Any]]:
+    """
+    Generate fixture mp3s and specs for them.
+    """
+    specs = []
+    for a in range(albums):
+        media = dir / "media" / f"album{a}"
+        media.mkdir(parents=True)
+        spec_tracks = []
+        for i in range(tracks):
+            seconds = 20.0 + (a * tracks + i) % 40
+            kind = ["exact", "search", "search", "missing"][i % 4]
+            title = f"{kind} {a}.{i} {seconds:.0f}"
+            (media / f"{i:02} - {title}.mp3").write_bytes(silent_mp3(seconds))
+            track: dict[str, t.Any] = {"title": title}
+            if i % 7 == 6:
+                track["lrc"] = {"id": 100 + i, "duration_slop": 60}
+            spec_tracks.append(track)
+
+        specs.append(
+            {
+                "url": media.as_uri(),
+                "album": f"Album {a}",
+                "album_artist": f"Artist {a % 3}",
+                "date": "2020-01-01",
+                "cover": f"{base}/cover/{a}",
+                "tracks": spec_tracks,
+            }
+        )
+    return specs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--albums", type=int, default=8)
+    parser.add_argument("--tracks", type=int, default=12)
+    parser.add_argument("--jobs", "-j", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=20, metavar="MS")
+    parser.add_argument("--passes", type=int, default=2)
+    parser.add_argument("--keep", type=Path, help="work in DIR and keep it")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="lyrebird-bench-") as tmp:
+        work = args.keep or Path(tmp)
+        work.mkdir(parents=True, exist_ok=True)
+
+        Stub.latency = args.latency / 1000
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Stub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}"
+
+        # lyrebird works out where its caches go when it's imported
+        os.environ["HOME"] = str(work / "home")
+        os.environ["LYREBIRD_LRCLIB_API"] = f"{base}/api"
+
+        from lyrebird import fetch
+        from lyrebird.cover import COVERS
+        from lyrebird.download import ENGINE
+        from lyrebird.pipeline import process_album
+        from lyrebird.profile import PROFILE
+        from lyrebird.schema import Album
+        import rich.console
+
+        specs = make_specs(work, args.albums, args.tracks, base)
+        albums = [Album(**spec) for spec in specs]
+        ntracks = sum(len(a.tracks) for a in albums)
+        print(f"{len(albums)} albums, {ntracks} tracks, -j {args.jobs}")
+
+        ENGINE.jobs = args.jobs
+        PROFILE.enabled = True
+
+        async def run(incremental: bool) -> None:
+            asyncio.get_running_loop().set_default_executor(
+                concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+            )
+            slots = asyncio.Semaphore(args.jobs)
+            sink = rich.console.Console(file=io.StringIO())
+
+            async def one(album: Album, i: int) -> None:
+                async with slots:
+                    outdir = work / "out" / f"album{i}"
+                    outdir.mkdir(parents=True, exist_ok=True)
+                    await process_album(album, outdir, sink, incremental)
+
+            async with asyncio.TaskGroup() as tg:
+                for i, album in enumerate(albums):
+                    tg.create_task(one(album, i))
+
+        for n in range(args.passes):
+            # as if it were a new process
+            fetch._INDEXES.clear()
+            COVERS._covers.clear()
+            COVERS._embeds.clear()
+            COVERS._url_locks.clear()
+            COVERS._buffers.clear()
+            PROFILE.spans.clear()
+
+            start = time.perf_counter()
+            # the download progress is just noise here
+            with contextlib.redirect_stdout(io.StringIO()):
+                asyncio.run(run(incremental=n > 0))
+            elapsed = time.perf_counter() - start
+
+            label = "cold" if n == 0 else "warm"
+            print(
+                f"pass {n + 1} ({label}): {elapsed:.2f}s,"
+                f" {ntracks / elapsed:.1f} tracks/s"
+            )
+            for row in PROFILE.summary():
+                print(
+                    f"  {row['stage']:>10}: {row['count']:4} spans,"
+                    f" p50 {row['p50'] * 1e3:8.2f}ms, p95 {row['p95'] * 1e3:8.2f}ms,"
+                    f" hit/miss {row['hits']}/{row['misses']}"
+                )
+
+        # ru_maxrss is in KiB on Linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"peak RSS: {rss / 1024:.0f}MiB")
+
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
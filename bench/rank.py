@@ -0,0 +1,78 @@
+"""
+Benchmark ranking of lrclib.net search results, against the old behaviour of
+sorting by duration alone.
+
+    python bench/rank.py [fixtures.json] [--repeat N]
+
+Each fixture is a search (track, artist, album, duration), results like
+lrclib.net's for it, and the id of the right result (or null if there isn't
+one). The default fixtures, bench/fixtures/search.json, are hand-written
+rather than recorded: small made-up result lists with the usual traps
+(covers, remasters, live versions, artists credited differently). Real
+/api/search responses, saved in the same format, can be given instead.
+"""
+
+from pathlib import Path
+import argparse
+import json
+import sys
+import time
+import typing as t
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from lyrebird import rank  # noqa: E402
+
+SLOP = 2.5
+
+
+def by_duration(query: rank.Query, results: list[dict[str, t.Any]]) -> int | None:
+    for r in sorted(results, key=lambda r: abs(r["duration"] - query.duration)):
+        if r["syncedLyrics"]:
+            return r["id"] if abs(r["duration"] - query.duration) <= SLOP else None
+    return None
+
+
+def by_rank(query: rank.Query, results: list[dict[str, t.Any]]) -> int | None:
+    for score, r in rank.rank(query, results, SLOP):
+        if r["syncedLyrics"]:
+            return r["id"] if score >= 0 else None
+    return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "fixtures",
+        nargs="?",
+        type=Path,
+        default=Path(__file__).parent / "fixtures" / "search.json",
+    )
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    cases = json.loads(args.fixtures.read_text())
+    queries = [rank.Query(*c["query"]) for c in cases]
+
+    for name, pick in [("duration", by_duration), ("rank", by_rank)]:
+        right = 0
+        for case, query in zip(cases, queries):
+            got = pick(query, case["results"])
+            if got == case["expect"]:
+                right += 1
+            else:
+                print(f"  {name}: {query.track!r} got {got}, want {case['expect']}")
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            rank.normalise.cache_clear()
+            rank.similarity.cache_clear()
+            for case, query in zip(cases, queries):
+                pick(query, case["results"])
+        per = (time.perf_counter() - start) / args.repeat / len(cases)
+
+        print(f"{name}: {right}/{len(cases)} right, {per * 1e6:.1f}us per search")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark loading specs and resolving their tracks' lyrics configs.
+
+    python bench/spec.py [spec.yaml ...] [--repeat N]
+
+Defaults to everything in spec/. Each stage is timed separately: parsing the
+yaml, validating it into an Album, and resolving every track's Lrc (with a
+made-up duration), both the way it's done now and by fully re-validating
+each merge like it used to be.
+"""
+
+from pathlib import Path
+import argparse
+import sys
+import time
+import typing as t
+import yaml
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from lyrebird.lrc import Lrc  # noqa: E402
+from lyrebird.schema import Album  # noqa: E402
+
+
+def validated_update(self: Lrc, other: Lrc) -> Lrc:
+    fields = {k: getattr(self, k) for k in self.model_fields_set}
+    fields |= {k: getattr(other, k) for k in other.model_fields_set}
+    return type(self)(**fields)
+
+
+def validated_lrcs(album: Album) -> list[Lrc]:
+    lrcs = []
+    for track in album.tracks:
+        lrc = Lrc(
+            track=track.title,
+            artist=", ".join(track.artists or [album.album_artist]),
+            album=album.album or track.title,
+            duration=180.0,
+        )
+        if not album.singles:
+            lrc = validated_update(lrc, album.lrc)
+        lrcs.append(validated_update(lrc, track.lrc))
+    return lrcs
+
+
+def bench(name: str, repeat: int, n: int, fn: t.Callable[[], t.Any]) -> None:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    total = (time.perf_counter() - start) / repeat
+    print(f"{name:>20}: {total * 1e3:8.2f}ms total, {total / n * 1e6:8.1f}us each")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spec", nargs="*", type=Path)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    paths = args.spec or sorted((ROOT / "spec").glob("*.yaml"))
+    texts = [p.read_text() for p in paths]
+    datas = [yaml.safe_load(text) for text in texts]
+    albums = [Album(**data) for data in datas]
+    ntracks = sum(len(a.tracks) for a in albums)
+    print(f"{len(paths)} specs, {ntracks} tracks")
+
+    bench("yaml", args.repeat, len(paths), lambda: [yaml.safe_load(x) for x in texts])
+    bench("validate", args.repeat, len(paths), lambda: [Album(**d) for d in datas])
+    bench(
+        "resolve (validated)",
+        args.repeat,
+        ntracks,
+        lambda: [validated_lrcs(a) for a in albums],
+    )
+    bench(
+        "resolve",
+        args.repeat,
+        ntracks,
+        lambda: [a.lrcs([180.0] * len(a.tracks)) for a in albums],
+    )
+
+    # make sure they agree
+    for album in albums:
+        assert list(album.lrcs([180.0] * len(album.tracks))) == validated_lrcs(album)
+
+
+if __name__ == "__main__":
+    main()
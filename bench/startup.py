@@ -0,0 +1,99 @@
+"""
+Benchmark how long `python -m lyrebird` takes to start, and check that slow
+imports stay out of the way when they're not needed.
+
+    python bench/startup.py [spec.yaml] [--repeat N] [--check] [--budget MS]
+
+This times `--validate-only` on a spec (the first in spec/ by default), once
+to warm the spec cache and then `--repeat` times, against a bare `python -c
+pass`. It also lists the slowest imports. With `--check`, it fails if any of
+the heavy dependencies were imported, or if it took more than `--budget` ms
+longer than bare python.
+"""
+
+from pathlib import Path
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# only needed for actually processing albums
+HEAVY = ("yt_dlp", "requests", "urllib3", "rich", "mutagen")
+
+
+def timed(args: list[str]) -> float:
+    start = time.perf_counter()
+    subprocess.run(args, check=True, cwd=ROOT, env=os.environ)
+    return time.perf_counter() - start
+
+
+def imports(args: list[str]) -> list[tuple[int, str]]:
+    """
+    Every module imported (indented by nesting), and its cumulative import
+    time in us.
+    """
+    r = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        check=True,
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    out = []
+    for line in r.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # names are indented by how deeply nested the import was
+        out.append((int(cumulative), name[1:]))
+    return out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spec", nargs="?", type=Path)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--budget", type=float, default=300, metavar="MS")
+    args = parser.parse_args()
+
+    spec = args.spec or sorted((ROOT / "spec").glob("*.yaml"))[0]
+    cli = ["-m", "lyrebird", "--validate-only", str(spec)]
+
+    timed([sys.executable, *cli])  # warm the spec cache
+    base = statistics.median(
+        timed([sys.executable, "-c", "pass"]) for _ in range(args.repeat)
+    )
+    run = statistics.median(timed([sys.executable, *cli]) for _ in range(args.repeat))
+    print(f"python: {base * 1e3:.0f}ms")
+    print(f"lyrebird --validate-only: {run * 1e3:.0f}ms (+{(run - base) * 1e3:.0f}ms)")
+
+    modules = imports(cli)
+    print("slowest top-level imports:")
+    top = [(us, name) for us, name in modules if not name.startswith(" ")]
+    for us, name in sorted(top, reverse=True)[:10]:
+        print(f"  {us / 1e3:7.1f}ms {name}")
+
+    heavy = sorted(
+        {name.strip() for _, name in modules if name.strip().split(".")[0] in HEAVY}
+    )
+    if heavy:
+        print(f"heavy imports: {', '.join(heavy)}")
+
+    if args.check:
+        ok = True
+        if heavy:
+            print("FAIL: heavy dependencies imported for --validate-only")
+            ok = False
+        if (run - base) * 1e3 > args.budget:
+            print(f"FAIL: over budget of {args.budget:.0f}ms")
+            ok = False
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,20 @@
-from .fetch import fetch_cover
-from .lrc import Lrc
-from .metadata import tag
+from .cover import COVERS
+from .download import ENGINE
+from .lrc import LRCLIB_CACHE
+from .lrc import LRCLIB_LOOKUPS
+from .lrc import STRATEGIES
+from .profile import PROFILE
 from .schema import Album
+from .speccache import load_spec
 from pathlib import Path
 import argparse
+import concurrent.futures
 import datetime as dt
-import mimetypes
-import rich.console
-import mutagen.mp3
-import shutil
-import yaml
 import asyncio
+import sys
 
-
-console = rich.console.Console()
-
-
-def sanitise_for_path(s: str):
-    return s.replace("/", "_")
-
-
-async def process_album(
-    album: Album,
-    outdir: Path,
-):
-    # fetch album stuff
-    fetched_files = album.fetch()
-    assert len(fetched_files) == len(album.tracks)
-
-    if album.cover:
-        mime, data = fetch_cover(album.cover)
-        ext = mimetypes.guess_extension(mime)
-        assert ext
-        with (outdir / f"cover{ext}").open("wb") as f:
-            f.write(data)
-
-    for i, (fetched_path, track) in enumerate(
-        zip(fetched_files, album.tracks), start=1
-    ):
-        path: Path = outdir / sanitise_for_path(
-            f"{track.title}.mp3" if album.singles else f"{i:02} - {track.title}.mp3"
-        )
-        console.print(f"===== {path.name}", style="bold yellow")
-
-        try:
-            mp3 = mutagen.mp3.MP3(fetched_path)
-            assert mp3.info
-            duration = dt.timedelta(seconds=mp3.info.length)
-            mm, ss = divmod(duration, dt.timedelta(minutes=1))
-
-            # copy into output
-            shutil.copyfile(fetched_path, path)
-
-            tags = tag(track, album, index=i)
-            tags.save(path, v1=0, v2_version=4)
-
-            lrc = Lrc.from_track(track, album, mp3.info.length)
-            if not album.singles:
-                lrc = lrc.update(album.lrc)
-            lrc = lrc.update(track.lrc)
-
-            if lyrics := lrc.load():
-                with path.with_suffix(".lrc").open("w") as f:
-                    f.write(lyrics)
-        except Exception:
-            console.print_exception()
+# Only what's needed to validate specs is imported up front, so that
+# --validate-only (and runs where --ifne skips everything) start quickly.
 
 
 async def main() -> None:
@@ -75,13 +25,110 @@ async def main() -> None:
     )
     parser.add_argument("--out", "-o", type=Path, default=Path.cwd())
     parser.add_argument("--ifne", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument(
+        "--incremental",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="only redo tracks whose inputs changed, and remove old outputs",
+    )
+    parser.add_argument(
+        "--retag",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="only rewrite the tags and covers of existing outputs, in place"
+        " where they fit, without downloading anything or looking up lyrics",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="number of albums, downloads, lookups etc. to run at once",
+    )
+    parser.add_argument(
+        "--refresh-lyrics",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="ignore cached lrclib.net responses",
+    )
+    parser.add_argument(
+        "--lyrics-ttl",
+        type=float,
+        metavar="DAYS",
+        default=LRCLIB_CACHE.ttl.days if LRCLIB_CACHE.ttl else None,
+        help="how long to keep found lyrics cached",
+    )
+    parser.add_argument(
+        "--lyrics-miss-ttl",
+        type=float,
+        metavar="DAYS",
+        default=LRCLIB_CACHE.miss_ttl.days if LRCLIB_CACHE.miss_ttl else None,
+        help="how long to remember that lyrics weren't found",
+    )
+    parser.add_argument(
+        "--lrc-strategy",
+        choices=STRATEGIES,
+        default=LRCLIB_LOOKUPS.strategy,
+        help="how to look up lyrics that don't have an id",
+    )
+    parser.add_argument(
+        "--lrc-stats",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="print how long lyric lookups took at the end",
+    )
+    parser.add_argument(
+        "--cover-size",
+        type=int,
+        metavar="PX",
+        default=COVERS.embed_size,
+        help="shrink covers embedded in tracks to fit within PX x PX, or 0 to"
+        " embed them as they are",
+    )
+    parser.add_argument(
+        "--cover-kb",
+        type=int,
+        metavar="KB",
+        default=COVERS.embed_bytes // 1000,
+        help="recompress covers embedded in tracks to fit within KB",
+    )
+    parser.add_argument(
+        "--watch",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="keep running, and incrementally rebuild albums whose specs change",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        metavar="SECONDS",
+        default=0.5,
+        help="with --watch, wait for this long without changes before rebuilding",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        metavar="FILE",
+        help="record how long each stage took to FILE, as a Chrome trace if it"
+        " ends in .json and JSON lines otherwise, and print a summary",
+    )
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    ENGINE.jobs = args.jobs
+    LRCLIB_CACHE.refresh = args.refresh_lyrics
+    LRCLIB_CACHE.ttl = dt.timedelta(days=args.lyrics_ttl)
+    LRCLIB_CACHE.miss_ttl = dt.timedelta(days=args.lyrics_miss_ttl)
+    LRCLIB_LOOKUPS.strategy = args.lrc_strategy
+    COVERS.embed_size = args.cover_size
+    COVERS.embed_bytes = args.cover_kb * 1000
+    PROFILE.enabled = args.profile is not None
 
     albums: list[tuple[Path, Album]] = []
     for spec in args.spec:
         try:
-            with spec.open("r") as f:
-                album = Album(**yaml.safe_load(f))
+            album = load_spec(spec)
         except Exception as e:
             parser.error(f"not valid: {spec}\n{e}")
         albums.append((spec, album))
@@ -89,24 +136,101 @@ async def main() -> None:
     if args.validate_only:
         return
 
+    todo: list[tuple[Path, Album, Path]] = []
     for spec, album in albums:
-        albumdir: Path = args.out / sanitise_for_path(
-            f"{album.album_artist}"
-            if album.singles
-            else f"{album.album_artist} - {album.album}"
-        )
-
+        albumdir: Path = args.out / album.dirname()
         if args.ifne and albumdir.exists():
             continue
+        todo.append((spec, album, albumdir))
+
+    if not todo and not args.watch:
+        return
+
+    from .pipeline import buffered
+    from .pipeline import flush
+    from .pipeline import process_album
+    from .pipeline import profile_table
+    from .pipeline import retag_album
+    import rich.console
 
-        console.print(f"===== {spec}", style="bold blue")
-        albumdir.mkdir(parents=True, exist_ok=True)
+    console = rich.console.Console()
 
+    # blocking work (downloads, lookups, disk io) all happens on this pool
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.jobs, thread_name_prefix="lyrebird"
+        )
+    )
+    slots = asyncio.Semaphore(args.jobs)
+
+    async def run(spec: Path, album: Album, albumdir: Path, incremental: bool) -> None:
+        async with slots:
+            out = buffered(console)
+            out.print(f"===== {spec}", style="bold blue")
+            try:
+                albumdir.mkdir(parents=True, exist_ok=True)
+                if args.retag:
+                    await retag_album(album, albumdir, out)
+                else:
+                    await process_album(album, albumdir, out, incremental)
+            except Exception:
+                out.print_exception()
+            finally:
+                flush(out, console)
+
+    async with asyncio.TaskGroup() as tg:
+        for spec, album, albumdir in todo:
+            tg.create_task(run(spec, album, albumdir, args.incremental))
+
+    if args.watch:
+        from .watch import watch
+
+        # Everything (the http client, caches, indexes of downloads, ...)
+        # stays loaded between rebuilds, so they're much quicker than a
+        # fresh run.
+        specs = {spec.resolve(): album for spec, album in albums}
+        dirs = sorted({spec.parent for spec in specs})
+        console.print(f"===== watching {len(dirs)} directories", style="bold")
         try:
-            await process_album(album, albumdir)
-        except Exception:
-            console.print_exception()
+            async for changed in watch(dirs, args.debounce):
+                async with asyncio.TaskGroup() as tg:
+                    for spec in sorted(changed):
+                        try:
+                            album = load_spec(spec)
+                        except FileNotFoundError:
+                            continue
+                        except Exception as e:
+                            console.print(f"===== {spec}", style="bold blue")
+                            console.print(f"not valid: {e}", style="red")
+                            continue
+                        if specs.get(spec) == album:
+                            continue  # saved, but not changed
+                        specs[spec] = album
+                        albumdir = args.out / album.dirname()
+                        tg.create_task(run(spec, album, albumdir, True))
+        except asyncio.CancelledError:
+            pass  # i.e. ^C, but still show the stats
+
+    if args.lrc_stats:
+        for line in LRCLIB_LOOKUPS.summary():
+            console.print(f"# lyrics {line}", highlight=False, soft_wrap=True)
+
+    if args.profile:
+        with args.profile.open("w") as f:
+            if args.profile.suffix == ".json":
+                PROFILE.write_chrome(f)
+            else:
+                PROFILE.write_jsonl(f)
+        console.print(profile_table(PROFILE.summary()))
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["verify"]:
+        from .verify import main as verify
+
+        sys.exit(asyncio.run(verify(sys.argv[2:])))
+    if sys.argv[1:2] == ["cache"]:
+        from .cachectl import main as cache
+
+        sys.exit(cache(sys.argv[2:]))
     asyncio.run(main())
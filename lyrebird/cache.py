@@ -0,0 +1,107 @@
+"""
+A small on-disk cache of JSON values.
+"""
+
+from pathlib import Path
+import contextlib
+import datetime as dt
+import hashlib
+import json
+import os
+import threading
+import time
+import typing as t
+
+
+class DiskCache:
+    """
+    JSON values stored under a directory, one file per entry, named by the
+    hash of their key.
+
+    A stored value of None records a miss (i.e. we looked, and there was
+    nothing), which expires after `miss_ttl` rather than `ttl`. Entries are
+    evicted least-recently-used first once the cache grows past `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        dir: Path,
+        ttl: dt.timedelta | None,
+        miss_ttl: dt.timedelta | None,
+        max_bytes: int,
+    ):
+        self.dir = dir
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.max_bytes = max_bytes
+
+        # ignore what's stored, but still write new results
+        self.refresh = False
+
+        self._lock = threading.Lock()
+        self._size: int | None = None  # lazily computed
+
+    def _path(self, key: str) -> Path:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.dir / digest[:2] / f"{digest}.json"
+
+    def get(self, key: str) -> tuple[bool, t.Any]:
+        """
+        Look up an entry, returning whether it was found and its value.
+        """
+        if self.refresh:
+            return False, None
+
+        path = self._path(key)
+        try:
+            with path.open("r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return False, None
+
+        if entry["key"] != key:
+            return False, None  # hash collision??
+
+        ttl = self.ttl if entry["value"] is not None else self.miss_ttl
+        if ttl is not None and time.time() - entry["time"] > ttl.total_seconds():
+            return False, None
+
+        # mark as recently used, unless it's just been evicted
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return True, entry["value"]
+
+    def put(self, key: str, value: t.Any) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        data = json.dumps({"key": key, "time": time.time(), "value": value})
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with tmp.open("w") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(p.stat().st_size for p in self.dir.glob("*/*.json"))
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """
+        Remove the least recently used entries until we're comfortably under
+        the size limit.
+        """
+        entries = sorted(
+            ((p, p.stat()) for p in self.dir.glob("*/*.json")),
+            key=lambda e: e[1].st_mtime,
+        )
+        size = sum(st.st_size for _, st in entries)
+        for path, st in entries:
+            if size <= self.max_bytes * 0.9:
+                break
+            path.unlink(missing_ok=True)
+            size -= st.st_size
+        self._size = size
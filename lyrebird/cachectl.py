@@ -0,0 +1,247 @@
+"""
+Looking after the download cache.
+
+    lyrebird cache stats
+    lyrebird cache pin SPEC|DIR...
+    lyrebird cache gc --max-size SIZE [--dry-run]
+    lyrebird cache dedup
+
+Downloads are kept in CACHEDIR, one directory per url, with each file
+hard-linked to a copy in BLOB_DIR named by its sha256, so the same audio
+downloaded from different urls is only stored once. `gc` removes the least
+recently used downloads until the downloads and blobs fit in SIZE, never
+touching those pinned by `pin` (which replaces the pinned set with what the
+given specs use). The other caches (covers, lyrics, ...) manage their own
+sizes.
+"""
+
+from .fetch import BLOB_DIR
+from .fetch import CACHEDIR
+from .fetch import LAST_USED_NAME
+from .fetch import canonical_url
+from .fetch import download_dir
+from .fetch import share
+from .index import INDEX_NAME
+from .index import Index
+from .speccache import load_spec
+from pathlib import Path
+import argparse
+import collections
+import json
+import os
+import re
+import shutil
+import typing as t
+
+PINS_PATH = CACHEDIR / "pinned.json"
+
+_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+# (st_dev, st_ino), so hard links are only counted once
+Inode = tuple[int, int]
+
+
+def parse_size(text: str) -> int:
+    m = re.fullmatch(r"([0-9.]+)\s*([KMGT]?)i?B?", text.strip().upper())
+    if not m:
+        raise ValueError(f"not a size: {text!r}")
+    return int(float(m.group(1)) * _UNITS[m.group(2)])
+
+
+def fmt_size(n: int) -> str:
+    size = float(n)
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TiB"
+
+
+def _files(dir: Path) -> dict[Inode, int]:
+    """
+    Every file under a directory, by inode, with its size.
+    """
+    files = {}
+    for root, _, names in os.walk(dir):
+        for name in names:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            files[st.st_dev, st.st_ino] = st.st_size
+    return files
+
+
+class Download(t.NamedTuple):
+    dir: Path
+    last_used: float
+    files: dict[Inode, int]
+
+
+def downloads() -> list[Download]:
+    """
+    Every download directory in the cache.
+    """
+    out = []
+    for dir in CACHEDIR.iterdir():
+        # directories are named by their url, with "/" as "%"
+        if not dir.is_dir() or "%" not in dir.name:
+            continue
+        for marker in (LAST_USED_NAME, INDEX_NAME, "."):
+            try:
+                last_used = (dir / marker).stat().st_mtime
+                break
+            except OSError:
+                pass
+        out.append(Download(dir, last_used, _files(dir)))
+    return out
+
+
+def blobs() -> dict[Inode, tuple[Path, int]]:
+    """
+    Every blob, by inode, with its size.
+    """
+    out = {}
+    for path in BLOB_DIR.glob("*/*"):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        out[st.st_dev, st.st_ino] = path, st.st_size
+    return out
+
+
+def pinned() -> set[Path]:
+    try:
+        with PINS_PATH.open("r") as f:
+            urls = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    return {download_dir(url) for url in urls}
+
+
+def spec_urls(paths: t.Iterable[Path]) -> set[str]:
+    """
+    The urls downloaded for some specs (or directories of them).
+    """
+    urls = set()
+    for path in paths:
+        for spec in sorted(path.rglob("*.yaml")) if path.is_dir() else [path]:
+            album = load_spec(spec)
+            for url in [album.url, *(track.url for track in album.tracks)]:
+                if url is not None:
+                    urls.add(canonical_url(url))
+    return urls
+
+
+def stats() -> None:
+    items = downloads()
+    pins = pinned()
+    blob_files = blobs()
+
+    refs = collections.Counter(inode for d in items for inode in d.files)
+    sizes = {inode: size for d in items for inode, size in d.files.items()}
+    total = sum(sizes.values())
+    apparent = sum(size for d in items for size in d.files.values())
+    shared = sum(1 for inode in blob_files if refs[inode] > 1)
+    unused = [size for inode, (_, size) in blob_files.items() if refs[inode] == 0]
+
+    print(
+        f"downloads: {len(items)} ({sum(d.dir in pins for d in items)} pinned),"
+        f" {fmt_size(total)}, {fmt_size(apparent - total)} saved by sharing"
+        f" {shared} files"
+    )
+    if unused:
+        print(f"unused blobs: {len(unused)}, {fmt_size(sum(unused))}")
+    for path in sorted(CACHEDIR.iterdir()):
+        if path.is_dir() and "%" not in path.name and path != BLOB_DIR:
+            print(f"{path.name}: {fmt_size(sum(_files(path).values()))}")
+
+
+def gc(max_size: int, dry_run: bool) -> None:
+    items = downloads()
+    pins = pinned()
+    blob_files = blobs()
+
+    refs = collections.Counter(inode for d in items for inode in d.files)
+    sizes = {inode: size for d in items for inode, size in d.files.items()}
+    for inode, (_, size) in blob_files.items():
+        sizes.setdefault(inode, size)
+    total = before = sum(sizes.values())
+
+    def remove(path: Path) -> None:
+        print(f"removing {path}")
+        if dry_run:
+            return
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink(missing_ok=True)
+
+    # blobs nothing uses any more
+    for inode, (path, size) in blob_files.items():
+        if refs[inode] == 0:
+            remove(path)
+            total -= size
+
+    # then downloads, least recently used first
+    for d in sorted(items, key=lambda d: d.last_used):
+        if total <= max_size:
+            break
+        if d.dir in pins:
+            continue
+        remove(d.dir)
+        for inode in d.files:
+            refs[inode] -= 1
+            if refs[inode] == 0:
+                total -= sizes[inode]
+                if inode in blob_files:
+                    remove(blob_files[inode][0])
+
+    print(f"{fmt_size(before)} -> {fmt_size(total)}")
+    if total > max_size:
+        print(f"still over {fmt_size(max_size)}, but the rest is pinned")
+
+
+def dedup() -> None:
+    """
+    Share the storage of files with the same contents, for downloads from
+    before this was done as they were downloaded.
+    """
+    for d in downloads():
+        index = Index.load(d.dir)
+        if index is None:
+            continue
+        for entry in index.entries.values():
+            share(d.dir / entry.file, entry.sha256)
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog="lyrebird cache")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="show how big the cache is")
+    pin = commands.add_parser("pin", help="keep what specs use from being removed")
+    pin.add_argument("spec", nargs="*", type=Path)
+    gc_ = commands.add_parser("gc", help="remove least recently used downloads")
+    gc_.add_argument("--max-size", type=parse_size, required=True, metavar="SIZE")
+    gc_.add_argument("--dry-run", action="store_true")
+    commands.add_parser("dedup", help="share storage between identical downloads")
+    args = parser.parse_args(argv)
+
+    CACHEDIR.mkdir(parents=True, exist_ok=True)
+    if args.command == "stats":
+        stats()
+    elif args.command == "pin":
+        try:
+            urls = sorted(spec_urls(args.spec))
+        except Exception as e:
+            parser.error(f"not valid: {e}")
+        tmp = PINS_PATH.with_name(f"{PINS_PATH.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(urls, indent=1))
+        os.replace(tmp, PINS_PATH)
+        print(f"pinned {len(urls)} urls")
+    elif args.command == "gc":
+        gc(args.max_size, args.dry_run)
+    elif args.command == "dedup":
+        dedup()
+    return 0
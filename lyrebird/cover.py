@@ -0,0 +1,408 @@
+"""
+Fetching and storing cover art.
+
+Covers are embedded into every track of an album, so they're also normalised
+for that: shrunk to fit a maximum size (in pixels and bytes), once, with the
+result stored alongside the originals.
+"""
+
+from .fetch import CACHEDIR
+from .net import HTTP
+from .profile import PROFILE
+from pathlib import Path
+import asyncio
+import collections
+import datetime as dt
+import hashlib
+import json
+import os
+import struct
+import subprocess
+import threading
+import time
+import typing as t
+
+
+class Cover(t.NamedTuple):
+    mime: str
+    data: bytes
+    digest: str  # sha256 of data
+
+
+def _mime(data: bytes) -> str | None:
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    return None
+
+
+def _dimensions(data: bytes) -> tuple[int, int] | None:
+    """
+    The width and height of a JPEG or PNG, read from its header.
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and data[12:16] == b"IHDR":
+        w, h = struct.unpack(">II", data[16:24])
+        return w, h
+
+    if data.startswith(b"\xff\xd8"):
+        i = 2
+        while i + 9 <= len(data) and data[i] == 0xFF:
+            marker = data[i + 1]
+            if marker == 0xFF:  # padding
+                i += 1
+                continue
+            # SOFn has the dimensions (C4, C8 and CC aren't SOFs)
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                h, w = struct.unpack(">HH", data[i + 5 : i + 9])
+                return w, h
+            (length,) = struct.unpack(">H", data[i + 2 : i + 4])
+            i += 2 + length
+
+    return None
+
+
+def _jpeg(data: bytes, size: int, quality: int) -> bytes:
+    """
+    Re-encode an image as a JPEG no more than size x size pixels.
+    """
+    scale = f"scale=w='min(iw,{size})':h='min(ih,{size})'"
+    r = subprocess.run(
+        [
+            *("ffmpeg", "-y", "-loglevel", "error", "-nostdin"),
+            *("-i", "pipe:0"),
+            *("-vf", f"{scale}:force_original_aspect_ratio=decrease"),
+            *("-frames:v", "1", "-c:v", "mjpeg", "-pix_fmt", "yuvj420p"),
+            *("-q:v", str(quality), "-f", "image2pipe", "pipe:1"),
+        ],
+        input=data,
+        capture_output=True,
+        check=True,
+    )
+    return r.stdout
+
+
+def normalise(data: bytes, size: int, max_bytes: int) -> tuple[str, bytes] | None:
+    """
+    Shrink a cover to fit within size x size pixels and max_bytes, giving the
+    new mime type and data. Covers which already fit (and are JPEG or PNG) are
+    left alone, giving None.
+    """
+    dims = _dimensions(data)
+    if dims and max(dims) <= size and len(data) <= max_bytes:
+        return None
+
+    # lower quality first, then smaller, until it fits
+    out = data
+    for scale in (1, 0.75, 0.5):
+        for quality in (3, 6, 12):
+            out = _jpeg(data, int(size * scale), quality)
+            if len(out) <= max_bytes:
+                return "image/jpeg", out
+    return "image/jpeg", out
+
+
+class _Buffers:
+    """
+    Cover data by digest, keeping the most recently used up to `max_bytes`,
+    so that everything using the same cover shares one copy of it.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, digest: str) -> bytes | None:
+        with self._lock:
+            data = self._data.get(digest)
+            if data is not None:
+                self._data.move_to_end(digest)
+            return data
+
+    def share(self, digest: str, data: bytes) -> bytes:
+        with self._lock:
+            if digest in self._data:
+                self._data.move_to_end(digest)
+                return self._data[digest]
+
+            self._data[digest] = data
+            self._size += len(data)
+            while self._size > self.max_bytes and len(self._data) > 1:
+                _, old = self._data.popitem(last=False)
+                self._size -= len(old)
+            return data
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+
+class CoverStore:
+    """
+    Covers stored on disk by the sha256 of their contents, so a cover
+    referenced from several urls is only stored once.
+
+    Each url records which blob it resolved to, along with its ETag and
+    Last-Modified, so that once it's `revalidate` old we can check whether it
+    has changed without downloading it again. Blobs are evicted
+    least-recently-used first once they add up to more than `max_bytes`.
+
+    Covers for embedding are normalised to `embed_size` pixels and
+    `embed_bytes` (unless `embed_size` is 0), and stored the same way. In
+    memory, only the most recently used `memory_bytes` of cover data is kept.
+    """
+
+    def __init__(
+        self,
+        dir: Path,
+        revalidate: dt.timedelta,
+        max_bytes: int,
+        embed_size: int,
+        embed_bytes: int,
+        memory_bytes: int,
+    ):
+        self.dir = dir
+        self.revalidate = revalidate
+        self.max_bytes = max_bytes
+        self.embed_size = embed_size
+        self.embed_bytes = embed_bytes
+
+        self._lock = threading.Lock()
+        self._size: int | None = None  # lazily computed
+
+        # what covers we've resolved this run (as mime and digest), so each is
+        # only fetched once
+        self._covers: dict[str, tuple[str, str]] = {}
+        self._embeds: dict[str, tuple[str, str]] = {}
+        self._url_locks: dict[str, asyncio.Lock] = {}
+        self._buffers = _Buffers(memory_bytes)
+
+    def _blob(self, digest: str) -> Path:
+        return self.dir / "blobs" / digest[:2] / digest
+
+    def _record(self, url: str) -> Path:
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return self.dir / "urls" / key[:2] / f"{key}.json"
+
+    def _share(self, digest: str, data: bytes) -> bytes:
+        return self._buffers.share(digest, data)
+
+    def _read(self, digest: str) -> bytes | None:
+        data = self._buffers.get(digest)
+        if data is None:
+            try:
+                data = self._share(digest, self._blob(digest).read_bytes())
+            except OSError:
+                return None
+        return data
+
+    def _load(self, url: str) -> tuple[dict[str, t.Any], bytes] | None:
+        """
+        Load what we have stored for a url, if anything.
+        """
+        try:
+            with self._record(url).open("r") as f:
+                record = json.load(f)
+            data = self._buffers.get(record["sha256"])
+            if data is None:
+                data = self._blob(record["sha256"]).read_bytes()
+
+            # mark as recently used
+            os.utime(self._blob(record["sha256"]))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return record, data
+
+    def _store(self, url: str, record: dict[str, t.Any], data: bytes | None) -> None:
+        """
+        Store the record for a url, along with its blob if it's new.
+        """
+        if data is not None:
+            blob = self._blob(record["sha256"])
+            if not blob.exists():
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                tmp = blob.with_name(f"{blob.name}.{threading.get_ident()}.tmp")
+                tmp.write_bytes(data)
+                os.replace(tmp, blob)
+                self._grow(len(data))
+
+        path = self._record(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with tmp.open("w") as f:
+            json.dump(record, f)
+        os.replace(tmp, path)
+
+    def _grow(self, size: int) -> None:
+        with self._lock:
+            if self._size is None:
+                self._size = sum(
+                    p.stat().st_size for p in self.dir.glob("blobs/*/*") if p.is_file()
+                )
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """
+        Remove the least recently used blobs until we're comfortably under the
+        size limit. Url records pointing at removed blobs are left dangling,
+        and are treated as if they weren't there.
+        """
+        blobs = sorted(
+            (
+                (p, p.stat())
+                for p in self.dir.glob("blobs/*/*")
+                if p.is_file() and not p.name.endswith(".tmp")
+            ),
+            key=lambda e: e[1].st_mtime,
+        )
+        size = sum(st.st_size for _, st in blobs)
+        for path, st in blobs:
+            if size <= self.max_bytes * 0.9:
+                break
+            path.unlink(missing_ok=True)
+            size -= st.st_size
+        self._size = size
+
+    async def get(self, url: str) -> Cover:
+        async with self._url_locks.setdefault(url, asyncio.Lock()):
+            if url in self._covers:
+                mime, digest = self._covers[url]
+                data = await asyncio.to_thread(self._read, digest)
+                if data is not None:
+                    return Cover(mime, data, digest)
+
+            cover = await self._get(url)
+            self._covers[url] = cover.mime, cover.digest
+            return cover
+
+    async def embed(self, url: str) -> Cover:
+        """
+        Get a cover, normalised for embedding.
+        """
+        if not self.embed_size:
+            return await self.get(url)
+
+        async with self._url_locks.setdefault(f"embed:{url}", asyncio.Lock()):
+            if url in self._embeds:
+                mime, digest = self._embeds[url]
+                data = await asyncio.to_thread(self._read, digest)
+                if data is not None:
+                    return Cover(mime, data, digest)
+
+            cover = await self._normalise(await self.get(url))
+            self._embeds[url] = cover.mime, cover.digest
+            return cover
+
+    async def _normalise(self, cover: Cover) -> Cover:
+        # the normalised cover is stored as if it were at this url
+        key = f"normalised:{cover.digest}:{self.embed_size}:{self.embed_bytes}"
+        with PROFILE.span("normalise") as span:
+            stored = await asyncio.to_thread(self._load, key)
+            if stored:
+                record, data = stored
+                span["cache"] = "hit"
+            else:
+                span["cache"] = "miss"
+                try:
+                    out = await asyncio.to_thread(
+                        normalise, cover.data, self.embed_size, self.embed_bytes
+                    )
+                except subprocess.CalledProcessError:
+                    # not something ffmpeg understands, so leave it as is
+                    out = None
+                except OSError:
+                    # no ffmpeg (for now), so don't remember this
+                    span["bytes"] = len(cover.data)
+                    return cover
+
+                if out is None:
+                    record = {"sha256": cover.digest, "mime": cover.mime}
+                    data = cover.data
+                    await asyncio.to_thread(self._store, key, record, None)
+                else:
+                    mime, data = out
+                    record = {"sha256": hashlib.sha256(data).hexdigest(), "mime": mime}
+                    await asyncio.to_thread(self._store, key, record, data)
+
+            span["bytes"] = len(data)
+            digest = record["sha256"]
+            return Cover(record["mime"], self._share(digest, data), digest)
+
+    async def _get(self, url: str) -> Cover:
+        with PROFILE.span("cover", url=url) as span:
+            cover, span["cache"] = await self._get_uncached(url)
+            span["bytes"] = len(cover.data)
+        return cover
+
+    async def _get_uncached(self, url: str) -> tuple[Cover, str]:
+        """
+        Fetch a cover, also saying whether it came from the cache ("hit"), was
+        revalidated, or had to be fetched ("miss").
+        """
+        stored = await asyncio.to_thread(self._load, url)
+
+        headers = {}
+        if stored:
+            record, data = stored
+            if time.time() - record["checked"] < self.revalidate.total_seconds():
+                digest = record["sha256"]
+                return Cover(record["mime"], self._share(digest, data), digest), "hit"
+
+            if record.get("etag"):
+                headers["if-none-match"] = record["etag"]
+            if record.get("last_modified"):
+                headers["if-modified-since"] = record["last_modified"]
+
+        r = await HTTP.get(url, headers=headers)
+        if stored and r.status_code == 304:
+            record, data = stored
+            record["checked"] = time.time()
+            await asyncio.to_thread(self._store, url, record, None)
+            digest = record["sha256"]
+            cover = Cover(record["mime"], self._share(digest, data), digest)
+            return cover, "revalidated"
+        r.raise_for_status()
+
+        data = r.content
+        digest = hashlib.sha256(data).hexdigest()
+        record = {
+            "url": url,
+            "sha256": digest,
+            "mime": r.headers["content-type"],
+            "etag": r.headers.get("etag"),
+            "last_modified": r.headers.get("last-modified"),
+            "checked": time.time(),
+        }
+        await asyncio.to_thread(self._store, url, record, data)
+        return Cover(record["mime"], self._share(digest, data), digest), "miss"
+
+
+COVERS = CoverStore(
+    CACHEDIR / "covers",
+    revalidate=dt.timedelta(days=30),
+    max_bytes=1024 * 1024 * 1024,
+    embed_size=1200,
+    embed_bytes=1000 * 1000,
+    memory_bytes=64 * 1024 * 1024,
+)
+
+
+async def fetch_cover(url: str) -> Cover:
+    """
+    Fetch a cover URL, returning its mime type and the data.
+    """
+    return await COVERS.get(url)
+
+
+async def embed_cover(url: str) -> Cover:
+    """
+    Fetch a cover URL, normalised for embedding into tracks.
+    """
+    return await COVERS.embed(url)
@@ -0,0 +1,258 @@
+"""
+Downloading everything at a url into a directory of mp3s.
+
+Entries of a playlist are downloaded concurrently, and each is transcoded to
+mp3 as soon as it's downloaded, so transcoding overlaps with downloading the
+rest. Files are named `NN - title.mp3` by their (1-based) position in the
+playlist.
+"""
+
+from .profile import PROFILE
+from pathlib import Path
+import concurrent.futures
+import contextvars
+import os
+import shutil
+import subprocess
+import threading
+import typing as t
+import urllib.parse
+
+AUDIO_SUFFIXES = frozenset({".mp3", ".m4a", ".opus", ".ogg", ".flac", ".wav", ".webm"})
+
+
+class Entry(t.NamedTuple):
+    number: int  # 1-based position in the playlist
+    info: dict[str, t.Any]  # whatever the extractor needs to download it
+
+
+Progress = t.Callable[[Entry, str], None]
+
+
+class Extractor(t.Protocol):
+    def entries(self, url: str) -> list[Entry]:
+        """
+        List what's at a url, without downloading anything.
+        """
+        ...
+
+    def download(self, entry: Entry, dir: Path, progress: Progress) -> Path:
+        """
+        Download an entry into dir, returning the file it was saved to. The
+        filename should start with the entry's number.
+        """
+        ...
+
+
+class YtdlpExtractor:
+    """
+    Download things with yt-dlp.
+    """
+
+    def __init__(self, params: dict[str, t.Any] | None = None):
+        self.params = dict(params or {})
+
+    def entries(self, url: str) -> list[Entry]:
+        from yt_dlp import YoutubeDL
+
+        with YoutubeDL({**self.params, "quiet": True}) as ydl:
+            info = ydl.extract_info(url, download=False, process=False)
+        assert info
+
+        if info.get("_type") in ("playlist", "multi_video"):
+            return [Entry(i, e) for i, e in enumerate(info["entries"], start=1)]
+        return [Entry(1, info)]
+
+    def download(self, entry: Entry, dir: Path, progress: Progress) -> Path:
+        from yt_dlp import YoutubeDL
+
+        reported = 0
+
+        def hook(d: dict[str, t.Any]) -> None:
+            nonlocal reported
+            if d["status"] == "downloading" and d.get("total_bytes"):
+                # only every 25%, so we don't flood the output
+                percent = 100 * d["downloaded_bytes"] // d["total_bytes"] // 25 * 25
+                if percent > reported:
+                    reported = percent
+                    progress(entry, f"{percent}%")
+
+        with YoutubeDL(
+            {
+                **self.params,
+                "format": "bestaudio/best",
+                "writethumbnail": True,
+                "quiet": True,
+                "noprogress": True,
+                "progress_hooks": [hook],
+                # s/%/%%/g for printf-string
+                "outtmpl": str(dir).replace("%", "%%")
+                + f"/{entry.number:02} - %(title)s.%(ext)s",
+            }
+        ) as ydl:
+            info = ydl.process_ie_result(dict(entry.info), download=True)
+
+        return Path(info["requested_downloads"][-1]["filepath"])
+
+
+class LocalExtractor:
+    """
+    "Download" local files, for file:// urls. A directory is treated as a
+    playlist of the audio files in it.
+    """
+
+    def entries(self, url: str) -> list[Entry]:
+        import urllib.request
+
+        path = Path(urllib.request.url2pathname(urllib.parse.urlsplit(url).path))
+        if path.is_dir():
+            files = sorted(p for p in path.iterdir() if p.suffix in AUDIO_SUFFIXES)
+        else:
+            files = [path]
+        return [
+            Entry(i, {"path": str(p), "title": p.stem})
+            for i, p in enumerate(files, start=1)
+        ]
+
+    def download(self, entry: Entry, dir: Path, progress: Progress) -> Path:
+        src = Path(entry.info["path"])
+        dst = dir / f"{entry.number:02} - {entry.info['title']}{src.suffix}"
+        shutil.copyfile(src, dst)
+        return dst
+
+
+def transcode(src: Path) -> Path:
+    """
+    Convert an audio file to mp3 alongside it, removing the original.
+    """
+    if src.suffix == ".mp3":
+        return src
+
+    dst = src.with_suffix(".mp3")
+    tmp = src.with_name(f".{dst.name}.tmp")
+    try:
+        subprocess.run(
+            [
+                *("ffmpeg", "-y", "-loglevel", "error", "-nostdin"),
+                *("-i", str(src)),
+                *("-vn", "-acodec", "libmp3lame", "-f", "mp3"),
+                str(tmp),
+            ],
+            check=True,
+        )
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    src.unlink()
+    return dst
+
+
+class Engine:
+    """
+    Downloads entries `jobs` at a time, and transcodes up to `transcode_jobs`
+    at a time.
+    """
+
+    def __init__(self, jobs: int = 4, transcode_jobs: int | None = None):
+        self.jobs = jobs
+        self.transcode_jobs = transcode_jobs or os.cpu_count() or 1
+
+        self.ytdlp = YtdlpExtractor()
+        self.local = LocalExtractor()
+
+    def extractor(self, url: str) -> Extractor:
+        if urllib.parse.urlsplit(url).scheme == "file":
+            return self.local
+        return self.ytdlp
+
+    def entries(self, url: str) -> list[Entry]:
+        return self.extractor(url).entries(url)
+
+    def run(
+        self,
+        url: str,
+        dir: Path,
+        entries: list[Entry] | None = None,
+        progress: Progress | None = None,
+        done: t.Callable[[Entry, Path], None] | None = None,
+    ) -> list[Path]:
+        """
+        Download the entries at a url (or just the given ones) into dir,
+        returning the mp3s in the same order.
+
+        `done` is called (from a worker thread) as soon as each entry is
+        finished, so callers can keep track of progress even if others fail.
+        """
+        extractor = self.extractor(url)
+        if entries is None:
+            entries = extractor.entries(url)
+        if progress is None:
+            progress = log_progress()
+
+        dir.mkdir(parents=True, exist_ok=True)
+
+        with (
+            concurrent.futures.ThreadPoolExecutor(
+                self.jobs, thread_name_prefix="lyrebird-download"
+            ) as downloads,
+            concurrent.futures.ThreadPoolExecutor(
+                self.transcode_jobs, thread_name_prefix="lyrebird-transcode"
+            ) as transcodes,
+        ):
+
+            def finish(entry: Entry, path: Path) -> Path:
+                with PROFILE.span("transcode", entry=entry.number) as span:
+                    span["skipped"] = path.suffix == ".mp3"
+                    path = transcode(path)
+                    span["bytes"] = path.stat().st_size
+                if done:
+                    done(entry, path)
+                return path
+
+            def fetch(entry: Entry) -> concurrent.futures.Future[Path]:
+                progress(entry, "downloading")
+                with PROFILE.span("download", entry=entry.number) as span:
+                    path = extractor.download(entry, dir, progress)
+                    span["bytes"] = path.stat().st_size
+                progress(entry, "transcoding")
+                ctx = contextvars.copy_context()
+                return transcodes.submit(ctx.run, finish, entry, path)
+
+            # the workers run with our context, so that spans are labelled
+            futures = [
+                downloads.submit(contextvars.copy_context().run, fetch, entry)
+                for entry in entries
+            ]
+
+            paths = []
+            errors = []
+            for entry, future in zip(entries, futures):
+                try:
+                    paths.append(future.result().result())
+                    progress(entry, "done")
+                except Exception as e:
+                    progress(entry, f"failed: {e}")
+                    errors.append(e)
+
+        if errors:
+            raise ExceptionGroup(f"failed to download from {url}", errors)
+        return paths
+
+
+def log_progress(log: t.Callable[[str], None] = print) -> Progress:
+    """
+    Report progress a line at a time through `log`. The workers report at
+    the same time, so it's only called by one at once.
+    """
+    lock = threading.Lock()
+
+    def progress(entry: Entry, status: str) -> None:
+        title = entry.info.get("title") or entry.info.get("url") or ""
+        with lock:
+            log(f"[download] {entry.number:02} {title}: {status}")
+
+    return progress
+
+
+ENGINE = Engine()
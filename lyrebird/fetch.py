@@ -2,48 +2,202 @@
 Specify how to fetch the MP3s for an album.
 """
 
+from .download import ENGINE
+from .download import Entry
+from .download import log_progress
 from .exc import ExpectError
 from .exc import ValidationError
+from .index import Index
+from .output import PADDING
+from .output import PREPAD
+from .output import prepad
+from .profile import PROFILE
 from pathlib import Path
-from yt_dlp import YoutubeDL
-import functools
+import asyncio
+import os
 import pydantic
-import requests
 import shutil
+import threading
 import typing as t
+import urllib.parse
 
 CACHEDIR = Path.home() / ".cache" / "lyrebird"
+STAGING_NAME = ".staging"
+# touched whenever a download is used, for garbage collection
+LAST_USED_NAME = ".used"
+# downloaded files, by their sha256, hard-linked from wherever they're used
+BLOB_DIR = CACHEDIR / "blobs"
 
+# query parameters that only say where a link was found
+_TRACKING = frozenset({"fbclid", "gclid", "igshid", "si", "feature", "pp"})
 
-def fetch_mp3s(url: str) -> Path:
-    dir = CACHEDIR / url.replace("/", "%")
-    if dir.exists():
-        return dir
+# one lock per url, so concurrent albums don't download the same thing twice
+_FETCH_LOCKS: dict[str, threading.Lock] = {}
 
+# Indexes of what we've fetched, shared by every track from the same url. Each
+# is kept along with its stamp, so that we notice if it changes on disk.
+_INDEXES: dict[str, tuple[int | None, Index]] = {}
+
+
+def canonical_url(url: str) -> str:
+    """
+    Normalise a url, so that different ways of writing the same thing share
+    one download: youtu.be, shorts and m./music. links become
+    www.youtube.com/watch?v=..., tracking parameters are dropped, and the
+    rest are sorted. This is only for naming downloads; what's downloaded is
+    still the url as written.
+    """
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in ("http", "https"):
+        return url
+
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != {"http": 80, "https": 443}[scheme]:
+        host += f":{parts.port}"
+    path = parts.path or "/"
+    query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+
+    if host in ("youtu.be", "www.youtu.be"):
+        query = [("v", path.strip("/")), *query]
+        host, path = "www.youtube.com", "/watch"
+    elif host in ("youtube.com", "m.youtube.com", "music.youtube.com"):
+        host = "www.youtube.com"
+    if host == "www.youtube.com":
+        scheme = "https"
+        if path.startswith("/shorts/"):
+            query = [("v", path.split("/")[2]), *query]
+            path = "/watch"
+        # anything else (timestamps, playlist position) doesn't change what's
+        # downloaded
+        keep = {"/watch": {"v", "list"}, "/playlist": {"list"}}.get(path)
+        if keep is not None:
+            query = [(k, v) for k, v in query if k in keep]
+
+    query = [
+        (k, v)
+        for k, v in query
+        if not k.startswith("utm_")
+        and k not in _TRACKING
+        and not (k == "from" and host.endswith("bandcamp.com"))
+    ]
+    return urllib.parse.urlunsplit(
+        (scheme, host, path, urllib.parse.urlencode(sorted(query)), "")
+    )
+
+
+def download_dir(url: str) -> Path:
+    """
+    Where a url is downloaded to.
+    """
+    return CACHEDIR / canonical_url(url).replace("/", "%")
+
+
+def share(path: Path, digest: str) -> None:
+    """
+    Make a downloaded file share its storage with any other download of the
+    same contents, by hard-linking both to one copy in BLOB_DIR.
+    """
+    blob = BLOB_DIR / digest[:2] / digest
+    try:
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(path, blob)
+            return  # the first with these contents
+        except FileExistsError:
+            pass
+
+        if path.stat().st_ino != blob.stat().st_ino:
+            tmp = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+            os.link(blob, tmp)
+            os.replace(tmp, path)
+    except OSError:
+        pass  # e.g. no hard links on this filesystem, which only costs space
+
+
+def fetch_index(url: str, log: t.Callable[[str], None] = print) -> tuple[Path, Index]:
+    """
+    Download a url if we haven't already, returning the directory it's in and
+    its index. Download progress is reported through `log`.
+    """
+    # downloads used to be stored under the url as it was written
+    legacy = CACHEDIR / url.replace("/", "%")
+    key = canonical_url(url)
+    dir = download_dir(url)
+    with _FETCH_LOCKS.setdefault(key, threading.Lock()):
+        if key in _INDEXES:
+            stamp, index = _INDEXES[key]
+            if stamp == index.stamp(dir):
+                return dir, index
+
+        if legacy != dir and legacy.exists() and not dir.exists():
+            legacy.rename(dir)
+        index = _fetch_mp3s(url, dir, log)
+        (dir / LAST_USED_NAME).touch()
+        index.check()
+        # durations are probed all at once, and then kept in the index
+        with PROFILE.span("probe", url=url) as span:
+            span["cache"] = "miss" if index.probe(dir) else "hit"
+            if span["cache"] == "miss":
+                index.save(dir)
+        _INDEXES[key] = index.stamp(dir), index
+        return dir, index
+
+
+def fetch_mp3s(url: str, log: t.Callable[[str], None] = print) -> Path:
+    dir, _ = fetch_index(url, log)
+    return dir
+
+
+def _fetch_mp3s(url: str, dir: Path, log: t.Callable[[str], None]) -> Index:
+    index = Index.load(dir)
+    if index is None and dir.exists():
+        index = Index.adopt(dir, url)
+        index.save(dir)
+    if index is not None and index.complete:
+        return index
+    if index is None:
+        index = Index(url=url)
+
+    # Only download what we don't already have. Each entry is downloaded into
+    # a staging directory, and only moved into place (and indexed) once it's
+    # complete, so a failure anywhere only loses what was in progress.
+    have = index.verified(dir)
     try:
-        with YoutubeDL(
-            {
-                "format": "bestaudio/best",
-                "postprocessors": [
-                    {
-                        "key": "FFmpegExtractAudio",
-                        "preferredcodec": "mp3",
-                    }
-                ],
-                "writethumbnail": True,
-                # s/%/%%/g for printf-string
-                "outtmpl": str(dir).replace("%", "%%")
-                + "/%(autonumber)02d - %(title)s.%(ext)s",
-            }
-        ) as ydl:
-            error = ydl.download([url])
-            if error:
-                raise RuntimeError(f"yt_dlp: {error}")
+        listed = ENGINE.entries(url)
     except Exception as e:
-        shutil.rmtree(dir)
-        raise e
-    else:
-        return dir
+        if not have:
+            raise
+        # e.g. it's been taken down, but we've still got what we had
+        log(f"[download] can't list {url}, using what's downloaded: {e}")
+        index.save(dir)
+        return index
+    entries = [e for e in listed if e.number not in have]
+
+    staging = dir / STAGING_NAME
+    staging.mkdir(parents=True, exist_ok=True)
+
+    def done(entry: Entry, path: Path) -> None:
+        from .cover import COVERS  # which imports us
+
+        # room for the biggest cover we'd embed, if there's a limit
+        prepad(path, COVERS.embed_bytes + PADDING if COVERS.embed_size else PREPAD)
+        path = path.replace(dir / path.name)
+        index.add(entry.number, path)
+        index.save(dir)
+        share(path, index.entries[entry.number].sha256)
+
+    ENGINE.run(url, staging, entries=entries, progress=log_progress(log), done=done)
+
+    # anything else (e.g. thumbnails)
+    for path in staging.iterdir():
+        if not path.name.startswith("."):
+            path.replace(dir / path.name)
+    shutil.rmtree(staging)
+
+    index.complete = True
+    index.save(dir)
+    return index
 
 
 # There's kinda 3 categories of specification:
@@ -58,43 +212,38 @@ def fetch_mp3s(url: str) -> Path:
 #    (optionally) a URL it is from.
 
 
+class Fetched(t.NamedTuple):
+    path: Path
+    duration: float  # seconds
+
+
 class _TrackSrc(pydantic.BaseModel):
     url: str
     expect_count: int | None
     file: int | str
 
-    def fetch(self) -> Path:
-        dir = fetch_mp3s(self.url)
+    def fetch(self, log: t.Callable[[str], None] = print) -> Fetched:
+        dir, index = fetch_index(self.url, log)
 
-        # list of (track number, path)
-        entries: list[tuple[int, Path]] = []
-        for path in dir.iterdir():
-            if path.suffix != ".mp3":
-                continue
-
-            index = int(path.name.split(" - ", maxsplit=1)[0])
-            entries.append((index, path))
-        entries = sorted(entries, key=lambda e: e[0])
-        for i, (scanned_i, path) in enumerate(sorted(entries), start=1):
-            assert i == scanned_i, f"skipped track index {i} (found {path} next)"
-
-        if self.expect_count is not None and self.expect_count != len(entries):
+        if self.expect_count is not None and self.expect_count != len(index.entries):
             raise ValidationError(
-                f"expected to fetch {self.expect_count} from {self.url}, got {len(entries)}"
+                f"expected to fetch {self.expect_count} from {self.url}, got {len(index.entries)}"
             )
 
         # get file
-        file: Path
+        number: int | None
         if isinstance(self.file, int):
-            _, file = entries[self.file]
+            number = self.file + 1
         elif isinstance(self.file, str):
-            file = dir / self.file
-            if not file.exists():
+            number = index.number(self.file)
+            if number is None:
                 raise ExpectError(f"url {self.url!r} did not yield file {self.file!r}")
         else:
             assert False
 
-        return file
+        entry = index.entries[number]
+        assert entry.duration is not None
+        return Fetched(dir / entry.file, entry.duration)
 
 
 class TrackFetch(pydantic.BaseModel):
@@ -168,23 +317,19 @@ class AlbumFetch(pydantic.BaseModel):
 
         return srcs
 
-    def fetch(self) -> list[Path]:
-        return [src.fetch() for src in self._srcs()]
-
-
-@functools.cache
-def fetch_cover(url: str) -> tuple[str, bytes]:
-    """
-    Fetch a cover URL, returning its mime type and the data.
-    """
-    r = requests.get(
-        url,
-        headers={
-            # "user-agent": "Mozilla/5.0 (X11; Linux x86_64; rv:143.0) Gecko/20100101 Firefox/143.0"
-        },
-    )
-    r.raise_for_status()
+    async def fetch(self, log: t.Callable[[str], None] = print) -> list[Fetched]:
+        """
+        Download everything the album needs, reporting progress through `log`
+        (from worker threads).
+        """
+        srcs = self._srcs()
+
+        # download each distinct url once, all at the same time
+        await asyncio.gather(
+            *(
+                asyncio.to_thread(fetch_mp3s, url, log)
+                for url in dict.fromkeys(src.url for src in srcs)
+            )
+        )
 
-    mime = r.headers["content-type"]
-    data = r.content
-    return mime, data
+        return [src.fetch(log) for src in srcs]
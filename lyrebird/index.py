@@ -0,0 +1,141 @@
+"""
+What's in a download cache directory.
+"""
+
+from .probe import probe_all
+from pathlib import Path
+import hashlib
+import os
+import pydantic
+import threading
+
+INDEX_NAME = ".index.json"
+
+
+def sha256_file(path: Path) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class IndexEntry(pydantic.BaseModel):
+    file: str
+    size: int
+    sha256: str
+    duration: float | None = None  # seconds
+
+
+class Index(pydantic.BaseModel):
+    """
+    The entries downloaded from a url so far, by their (1-based) number.
+
+    The directory is only complete once every entry from the url has been
+    downloaded; until then, it's only a partial download to be resumed.
+    """
+
+    url: str
+    complete: bool = False
+    entries: dict[int, IndexEntry] = {}
+
+    _lock: threading.Lock = pydantic.PrivateAttr(default_factory=threading.Lock)
+    _by_file: dict[str, int] | None = pydantic.PrivateAttr(default=None)
+
+    @classmethod
+    def load(cls, dir: Path) -> "Index | None":
+        try:
+            return cls.model_validate_json((dir / INDEX_NAME).read_bytes())
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def adopt(cls, dir: Path, url: str) -> "Index":
+        """
+        Index a directory that was downloaded before there were indexes.
+        Downloads that were killed partway through (rather than failing) left
+        partial directories behind, so it's only taken as complete if it has
+        every entry from the first to the last. Otherwise, the next fetch
+        downloads whatever's missing.
+        """
+        index = cls(url=url)
+        for path in dir.glob("*.mp3"):
+            number = int(path.name.split(" - ", maxsplit=1)[0])
+            index.add(number, path)
+        index.complete = sorted(index.entries) == list(range(1, len(index.entries) + 1))
+        return index
+
+    def stamp(self, dir: Path) -> int | None:
+        """
+        Something that changes whenever the saved index does.
+        """
+        try:
+            return (dir / INDEX_NAME).stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self) -> None:
+        """
+        Make sure the entries are numbered 1..N with nothing skipped.
+        """
+        for i, number in enumerate(sorted(self.entries), start=1):
+            assert i == number, f"skipped track index {i} (found {number} next)"
+
+    def number(self, file: str) -> int | None:
+        """
+        Look up the number of an entry by its filename.
+        """
+        if self._by_file is None:
+            self._by_file = {e.file: n for n, e in self.entries.items()}
+        return self._by_file.get(file)
+
+    def save(self, dir: Path) -> None:
+        with self._lock:
+            data = self.model_dump_json(indent=1)
+        tmp = dir / f"{INDEX_NAME}.{threading.get_ident()}.tmp"
+        tmp.write_text(data)
+        os.replace(tmp, dir / INDEX_NAME)
+
+    def add(self, number: int, path: Path) -> None:
+        entry = IndexEntry(
+            file=path.name,
+            size=path.stat().st_size,
+            sha256=sha256_file(path),
+        )
+        with self._lock:
+            self.entries[number] = entry
+            self._by_file = None
+
+    def probe(self, dir: Path) -> bool:
+        """
+        Fill in the durations of entries that don't have one yet, returning
+        whether there were any.
+        """
+        missing = [n for n, e in self.entries.items() if e.duration is None]
+        if not missing:
+            return False
+        durations = probe_all(dir / self.entries[n].file for n in missing)
+        with self._lock:
+            for number, duration in zip(missing, durations):
+                self.entries[number].duration = duration
+        return True
+
+    def verified(self, dir: Path) -> set[int]:
+        """
+        Check entries against their checksums, removing those that don't
+        match, and returning the numbers of those that do.
+        """
+        ok = set()
+        for number, entry in list(self.entries.items()):
+            path = dir / entry.file
+            try:
+                if (
+                    path.stat().st_size == entry.size
+                    and sha256_file(path) == entry.sha256
+                ):
+                    ok.add(number)
+                    continue
+            except OSError:
+                pass
+            path.unlink(missing_ok=True)
+            with self._lock:
+                del self.entries[number]
+                self._by_file = None
+        return ok
@@ -2,31 +2,132 @@
 Fetching and processing lyrics.
 """
 
+from .cache import DiskCache
+from .fetch import CACHEDIR
+from .lrcfile import LrcFile
+from .lrcfile import fmt_ms
 from .metadata import AlbumMeta
 from .metadata import TrackMeta
+from .net import HTTP
+from .profile import PROFILE
+from .rank import Query
+from .rank import rank
+import asyncio
 import datetime as dt
+import json
+import os
 import pydantic
-import re
-import requests
+import statistics
+import time
 import typing as t
 
+# overridable so we can point at a local stand-in
+LRCLIB_API_BASE = os.environ.get("LYREBIRD_LRCLIB_API", "https://lrclib.net/api")
 
-LRCLIB_API_BASE = "https://lrclib.net/api"
+# Lyrics rarely change once they're up, but new ones do get added, so misses
+# are rechecked much sooner than hits.
+LRCLIB_CACHE = DiskCache(
+    CACHEDIR / "lrclib",
+    ttl=dt.timedelta(days=365),
+    miss_ttl=dt.timedelta(days=7),
+    max_bytes=256 * 1024 * 1024,
+)
 
-RE_LRC = re.compile(r"\[(\d\d):(\d\d)\.(\d\d)\](.*)")
 
-HTTP = requests.Session()
-HTTP.headers["user-agent"] = "lyrebird/0 (https://github.com/ralismark/lyrebird)"
+# How to look up lyrics (without an id):
+# - sequential: the exact match, then a search if that didn't find anything
+# - parallel: both at once, still preferring the exact match, but without
+#   waiting for it before starting the search
+# - search: only search
+STRATEGIES = ("sequential", "parallel", "search")
 
 
-def fmt_timedelta(t: dt.timedelta) -> str:
-    neg = t < dt.timedelta()
-    t = abs(t)
+class Lookups:
+    """
+    Which strategy to use for lookups, and how long they took and what they
+    found, by strategy, so we can tell which is better.
+    """
 
-    mm, t = divmod(t, dt.timedelta(minutes=1))
-    ss, t = divmod(t, dt.timedelta(seconds=1))
-    xx = t // dt.timedelta(milliseconds=10)
-    return f"{"-" if neg else ""}{mm:02}:{ss:02}.{xx:02}"
+    def __init__(self, strategy: str = "sequential") -> None:
+        self.strategy = strategy
+        self.times: dict[str, list[float]] = {}
+        self.sources: dict[str, dict[str, int]] = {}
+
+    def record(self, strategy: str, source: str | None, seconds: float) -> None:
+        self.times.setdefault(strategy, []).append(seconds)
+        sources = self.sources.setdefault(strategy, {})
+        sources[source or "miss"] = sources.get(source or "miss", 0) + 1
+
+    def summary(self) -> list[str]:
+        lines = []
+        for strategy, times in sorted(self.times.items()):
+            sources = self.sources[strategy]
+            hits = len(times) - sources.get("miss", 0)
+            found = ", ".join(f"{k}={v}" for k, v in sorted(sources.items()))
+            lines.append(
+                f"{strategy}: {len(times)} lookups, {hits / len(times):.0%} hit"
+                f" ({found}), mean {statistics.fmean(times):.3f}s,"
+                f" median {statistics.median(times):.3f}s, max {max(times):.3f}s"
+            )
+        return lines
+
+
+LRCLIB_LOOKUPS = Lookups()
+
+
+def _normalise(value: str | int) -> str | int:
+    if isinstance(value, str):
+        return " ".join(value.casefold().split())
+    return value
+
+
+# requests that are still going after whoever wanted them gave up
+_PENDING: set[asyncio.Task[t.Any]] = set()
+
+
+def _forget(task: asyncio.Task[t.Any]) -> None:
+    _PENDING.discard(task)
+    if not task.cancelled():
+        task.exception()  # nobody else will look at it
+
+
+async def _request(key: str, endpoint: str, params: dict[str, str | int]) -> t.Any:
+    r = await HTTP.get(f"{LRCLIB_API_BASE}{endpoint}", params=params)
+    if r.status_code == 404:
+        data = None
+    else:
+        r.raise_for_status()
+        data = r.json()
+
+    LRCLIB_CACHE.put(key, data)
+    return data, len(r.content)
+
+
+async def lrclib_get(
+    endpoint: str, params: dict[str, str | int] | None = None
+) -> t.Any:
+    """
+    Query the lrclib.net API, returning the response json or None if there
+    wasn't anything (i.e. 404). Responses are cached.
+    """
+    params = params or {}
+    key = json.dumps(
+        [endpoint, {k: _normalise(v) for k, v in params.items()}], sort_keys=True
+    )
+    with PROFILE.span("lrclib", endpoint=endpoint) as span:
+        found, data = LRCLIB_CACHE.get(key)
+        span["cache"] = "hit" if found else "miss"
+        if found:
+            return data
+
+        # Once sent, a request is finished and cached even if we're cancelled
+        # (e.g. the search that loses to an exact match, with the parallel
+        # strategy), so it doesn't have to be sent again next time.
+        task = asyncio.ensure_future(_request(key, endpoint, params))
+        _PENDING.add(task)
+        task.add_done_callback(_forget)
+        data, span["bytes"] = await asyncio.shield(task)
+        return data
 
 
 class LrclibResult(pydantic.BaseModel):
@@ -43,7 +144,7 @@ class LrclibResult(pydantic.BaseModel):
 
 
 class Lrc(pydantic.BaseModel):
-    model_config = pydantic.ConfigDict(extra="forbid")
+    model_config = pydantic.ConfigDict(extra="forbid", frozen=True)
 
     # Validation
     expect: bool | None = None
@@ -68,50 +169,77 @@ class Lrc(pydantic.BaseModel):
     # Validator ===============================================================
 
     @pydantic.model_validator(mode="after")
-    def _validate_id(self) -> t.Self:
-        if self.id is not None and self.expect is False:
-            raise ValueError("instrumental track cannot have id set")
+    def _validate(self) -> t.Self:
+        self._check()
         return self
 
-    @pydantic.model_validator(mode="after")
-    def _validate_offset_nand_start(self) -> t.Self:
+    def _check(self) -> None:
+        """
+        Checks between fields, which need redoing whenever they're combined.
+        """
+        if self.id is not None and self.expect is False:
+            raise ValueError("instrumental track cannot have id set")
         if self.offset and self.start:
             raise ValueError("cannot set both offset and start")
-        return self
 
     # =========================================================================
 
     @classmethod
-    def from_track(cls, track: TrackMeta, album: AlbumMeta, duration: float) -> t.Self:
-        return cls(
-            track=track.title,
-            artist=", ".join(track.artists or [album.album_artist]),
-            album=album.album or track.title,
-            duration=duration,
-        )
+    def from_track(
+        cls,
+        track: TrackMeta,
+        album: AlbumMeta,
+        duration: float,
+        *overrides: "Lrc",
+    ) -> t.Self:
+        """
+        The config for a track, with the fields set in each of `overrides`
+        applied on top in turn. This is the same as calling `update` with
+        each, but only builds one model.
+        """
+        fields: dict[str, t.Any] = {
+            "track": track.title,
+            "artist": ", ".join(track.artists or [album.album_artist]),
+            "album": album.album or track.title,
+            "duration": duration,
+        }
+        for other in overrides:
+            fields |= {k: getattr(other, k) for k in other.model_fields_set}
+        return cls(**fields)
 
     def update(self, other: t.Self) -> t.Self:
-        fields = {k: getattr(self, k) for k in self.model_fields_set}
-        fields |= {k: getattr(other, k) for k in other.model_fields_set}
-        return type(self)(**fields)
+        """
+        Override the fields of this with those that were set in other.
+        """
+        if not other.model_fields_set:
+            return self
+
+        # Both sides are already valid, so only the checks between fields
+        # need to be redone, not the whole validation.
+        merged = self.model_copy(
+            update={k: getattr(other, k) for k in other.model_fields_set}
+        )
+        merged._check()
+        return merged
 
     def _load_local(self) -> LrclibResult | None:
         """
         Try to load .lrc from inline
         """
         if self.from_text:
-            _, last = self.from_text.strip().rsplit("\n", 1)
-            m = RE_LRC.fullmatch(last)
-            assert m
-            mm, ss, xx, line = m.groups()
-            assert not line.strip()
+            # the last line should be an empty one marking the end
+            lines = list(LrcFile(self.from_text).lines())
+            if not lines:
+                raise ValueError("from_text has no timed lines")
+            end, line = lines[-1]
+            assert not line, "from_text should end with an empty timed line"
 
             return LrclibResult(
                 id=0,
                 trackName=self.track,
                 artistName=self.artist,
                 albumName=self.album,
-                duration=int(mm) * 60 + int(ss) + int(xx) / 100,
+                duration=end / 1000,
                 instrumental=False,
                 plainLyrics=None,
                 syncedLyrics=self.from_text,
@@ -120,59 +248,88 @@ class Lrc(pydantic.BaseModel):
 
         return None
 
-    def _fetch(self) -> LrclibResult | None:
+    async def _by_id(self) -> LrclibResult | None:
+        data = await lrclib_get(f"/get/{self.id}")
+        if data is None:
+            raise LookupError(f"lrclib.net has no id {self.id}")
+        return LrclibResult(**data, source="id")
+
+    async def _exact(self) -> LrclibResult | None:
+        data = await lrclib_get(
+            "/get",
+            {
+                "track_name": self.track,
+                "artist_name": self.artist,
+                "album_name": self.album,
+                "duration": round(self.duration),
+            },
+        )
+        if data is not None:
+            result = LrclibResult(**data, source="exact")
+            if result.syncedLyrics:
+                return result
+        return None
+
+    async def _search(self) -> LrclibResult | None:
+        data = await lrclib_get(
+            "/search",
+            {
+                "track_name": self.track,
+                "artist_name": self.artist,
+                "album_name": self.album,
+            },
+        )
+        query = Query(self.track, self.artist, self.album, self.duration)
+        for _, x in rank(query, data or [], self.duration_slop):
+            if not x.get("syncedLyrics"):
+                continue  # we don't care about unsynced lyrics
+            return LrclibResult(**x, source="search")
+        return None
+
+    async def _fetch(self) -> LrclibResult | None:
         """
         Try to fetch .lrc from lrclib.net
         """
         # if id, use that directly
         if self.id:
-            r = HTTP.get(f"{LRCLIB_API_BASE}/get/{self.id}")
-            r.raise_for_status()
-            return LrclibResult(**r.json(), source="id")
-
-        # try match
-        if self.try_exact:
-            r = HTTP.get(
-                f"{LRCLIB_API_BASE}/get",
-                params=t.cast(
-                    t.Any,
-                    {
-                        "track_name": self.track,
-                        "artist_name": self.artist,
-                        "album_name": self.album,
-                        "duration": round(self.duration),
-                    },
-                ),
-            )
-            if r.status_code != 404:
-                r.raise_for_status()
-                data = LrclibResult(**r.json(), source="exact")
-                if data.syncedLyrics:
-                    return data
-
-        # fallback: search
-        if self.try_search:
-            r = HTTP.get(
-                f"{LRCLIB_API_BASE}/search",
-                params={
-                    "track_name": self.track,
-                    "artist_name": self.artist,
-                    "album_name": self.album,
-                },
-            )
-            r.raise_for_status()
-            matches = sorted(
-                [LrclibResult(**x, source="search") for x in r.json()],
-                key=lambda m: abs(m.duration - self.duration),
-            )
-            for m in matches:
-                if not m.syncedLyrics:
-                    continue  # we don't care about unsynced lyrics
-                return m
-
-        return None
-
-    def _postprocess(self, lrc: str) -> str:
+            strategy = "id"
+            lookups = [self._by_id]
+        elif LRCLIB_LOOKUPS.strategy == "search":
+            strategy = "search"
+            lookups = [self._search] if self.try_search else []
+        else:
+            strategy = LRCLIB_LOOKUPS.strategy
+            lookups = []
+            if self.try_exact:
+                lookups.append(self._exact)
+            if self.try_search:
+                lookups.append(self._search)
+
+        start = time.perf_counter()
+        result = None
+        try:
+            if strategy == "parallel":
+                # Start everything at once, but still take the results in
+                # order of preference; whatever's left once we have one is
+                # cancelled.
+                tasks = [asyncio.create_task(lookup()) for lookup in lookups]
+                try:
+                    for task in tasks:
+                        if result := await task:
+                            break
+                finally:
+                    for task in tasks:
+                        task.cancel()
+            else:
+                for lookup in lookups:
+                    if result := await lookup():
+                        break
+            return result
+        finally:
+            source = result.source if result else None
+            LRCLIB_LOOKUPS.record(strategy, source, time.perf_counter() - start)
+
+    def _postprocess(self, lrc: str, log: t.Callable[[str], None] = print) -> str:
         """
         Perform post-processing steps on a lrc file.
         """
@@ -180,56 +337,71 @@ class Lrc(pydantic.BaseModel):
         if self.offset is None and self.start is None:
             return lrc
 
-        offset = self.offset or dt.timedelta()
-
-        lines = []
-        for i, line in enumerate(lrc.split("\n")):
-            if not line:
-                continue
-
-            # read
-            m = RE_LRC.fullmatch(line)
-            assert m
-            mm, ss, xx, lyric = m.groups()
-            timestamp = dt.timedelta(
-                minutes=int(mm), seconds=int(ss), milliseconds=10 * int(xx)
-            )
-
-            # apply offset
-            if i == 0 and self.start:
-                offset = self.start - timestamp
-                print(f"    # offset: {fmt_timedelta(offset)}")
+        lines = LrcFile(lrc)
+        first = lines.first()
+        if first is None:
+            return lrc
 
-            timestamp += offset
+        if self.start:
+            offset = self.start // dt.timedelta(milliseconds=1) - first
+            log(f"    # offset: {fmt_ms(offset)}")
+        else:
+            offset = (self.offset or dt.timedelta()) // dt.timedelta(milliseconds=1)
+            log(f"    start: {fmt_ms(first + offset)}")
 
-            if i == 0 and not self.start:
-                print(f"    start: {fmt_timedelta(timestamp)}")
+        lines.shift(offset)
+        return lines.format()
 
-            # write
-            timestamp = max(timestamp, dt.timedelta())
-            line = f"[{fmt_timedelta(timestamp)}]{lyric}"
-            assert RE_LRC.fullmatch(line), f"{timestamp=} {line=}"
-            lines.append(line)
-        return "\n".join(lines)
+    async def lookup(self) -> LrclibResult | None:
+        """
+        Find the lyrics, without checking or processing them.
+        """
+        if self.expect is False:
+            return None
+        return self._load_local() or await self._fetch()
 
-    def load(self) -> str | None:
+    async def load(
+        self,
+        log: t.Callable[[str], None] = print,
+        found: t.Awaitable[LrclibResult | None] | None = None,
+    ) -> str | None:
+        """
+        Find and process the lyrics. `found` is the result of `lookup`, if
+        that's already been started.
+        """
         if self.expect is False:
             return None
 
-        print("  lrc:")
+        log("  lrc:")
 
-        result = self._load_local() or self._fetch()
+        result = await (found or self.lookup())
         if not result or not result.syncedLyrics:
             assert not self.expect, f"Expected lyrics but did not find ({result=})"
-            print("    expect: false # did not find")
+            log("    expect: false # did not find")
             return None
 
-        print(f"    id: {result.id}")
+        log(f"    id: {result.id}")
         assert (
             abs(result.duration - self.duration) <= self.duration_slop
         ), f"lrc duration {result.duration}s too different from mp3 duration {self.duration}s"
 
         lrc = result.syncedLyrics
-        lrc = self._postprocess(lrc)
+        lrc = self._postprocess(lrc, log)
 
         return lrc
+
+
+def prefetch(lrcs: t.Iterable[Lrc]) -> list[asyncio.Task[LrclibResult | None]]:
+    """
+    Start looking up lyrics for a batch of tracks all at once, only doing
+    each distinct lookup once.
+    """
+    tasks: dict[str, asyncio.Task[LrclibResult | None]] = {}
+    found = []
+    for lrc in lrcs:
+        # postprocessing doesn't change what we look up
+        key = lrc.model_dump_json(exclude={"offset", "start"})
+        if key not in tasks:
+            tasks[key] = asyncio.create_task(lrc.lookup())
+        found.append(tasks[key])
+    return found
@@ -0,0 +1,121 @@
+"""
+A compact model of .lrc files, for retiming them.
+
+A file is kept as its original text, plus arrays of where each timestamp is
+and what time it's at. Line timestamps (`[mm:ss.xx]`, possibly several per
+line) and word timestamps (`<mm:ss.xx>`) are both understood; anything else,
+like metadata tags (`[ar:...]`), is just text. Times are in milliseconds.
+Formatting gives back unchanged timestamps exactly as they were parsed, and
+writes retimed ones as mm:ss.xx, which is what players expect.
+"""
+
+from array import array
+import re
+import typing as t
+
+# a run of line timestamps at the start of a line, or a word timestamp
+_RE_TOKEN = re.compile(
+    r"^(?:\[\d+:\d\d(?:[.:]\d{1,3})?\])+|<\d+:\d\d(?:[.:]\d{1,3})?>", re.MULTILINE
+)
+_RE_STAMP = re.compile(r"[\[<](\d+):(\d\d)(?:([.:])(\d{1,3}))?[\]>]")
+
+_SCALE = (1000, 100, 10, 1)  # ms per unit, by number of decimal places
+
+
+def fmt_ms(ms: int) -> str:
+    """
+    Format a time as mm:ss.xx, to the nearest hundredth of a second.
+    """
+    neg = ms < 0
+    cs = (abs(ms) + 5) // 10
+    mm, cs = divmod(cs, 6000)
+    ss, cs = divmod(cs, 100)
+    sign = "-" if neg else ""
+    return f"{sign}{mm:02}:{ss:02}.{cs:02}"
+
+
+class LrcFile:
+    """
+    A parsed .lrc file.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+
+        # one of each per timestamp, in order
+        self.starts = array("l")  # span in text
+        self.ends = array("l")
+        self.times = array("q")  # ms
+        self.line = array("l")  # which line it's on
+        self.word = array("b")  # whether it's a <word> timestamp
+
+        line = 0
+        last = 0
+        for token in _RE_TOKEN.finditer(text):
+            line += text.count("\n", last, token.start())
+            last = token.start()
+            word = token[0][0] == "<"
+            for m in _RE_STAMP.finditer(text, token.start(), token.end()):
+                mm, ss, _, frac = m.groups()
+                places = len(frac) if frac else 0
+                self.starts.append(m.start())
+                self.ends.append(m.end())
+                self.times.append(
+                    int(mm) * 60_000
+                    + int(ss) * 1000
+                    + (int(frac) * _SCALE[places] if frac else 0)
+                )
+                self.line.append(line)
+                self.word.append(word)
+
+        # the original times, so unchanged timestamps are kept verbatim
+        self._parsed = array("q", self.times)
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def lines(self) -> t.Iterator[tuple[int, str]]:
+        """
+        The time and text of each timed line, once for each of its line
+        timestamps.
+        """
+        end = len(self.text)
+        for i in range(len(self)):
+            if self.word[i]:
+                continue
+            eol = self.text.find("\n", self.ends[i])
+            text = self.text[self.ends[i] : end if eol < 0 else eol]
+            yield self.times[i], _RE_TOKEN.sub("", text).strip()
+
+    def first(self) -> int | None:
+        """
+        Time of the first line.
+        """
+        for i in range(len(self)):
+            if not self.word[i]:
+                return self.times[i]
+        return None
+
+    def shift(self, ms: int) -> None:
+        """
+        Move every timestamp by some amount, without going before the start.
+        """
+        self.times = array("q", [max(x + ms, 0) for x in self.times])
+
+    def format(self) -> str:
+        parts = []
+        last = 0
+        text = self.text
+        for start, end, time, parsed in zip(
+            self.starts, self.ends, self.times, self._parsed
+        ):
+            if time == parsed:
+                continue
+            open, close = text[start], text[end - 1]
+            parts += [text[last:start], open, fmt_ms(time), close]
+            last = end
+        parts.append(text[last:])
+        return "".join(parts)
+
+    def __str__(self) -> str:
+        return self.format()
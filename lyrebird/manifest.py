@@ -0,0 +1,162 @@
+"""
+Tracking what went into each output, so unchanged tracks can be skipped.
+"""
+
+from pathlib import Path
+import hashlib
+import json
+import os
+import typing as t
+
+MANIFEST_NAME = ".lyrebird.json"
+
+# bump this when the output for the same inputs would change
+VERSION = 1
+
+
+def fingerprint(*parts: t.Any) -> str:
+    """
+    Hash some json-able values.
+    """
+    data = json.dumps([VERSION, *parts], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def file_fingerprint(path: Path) -> dict[str, t.Any]:
+    """
+    Cheap identity of a file, which changes whenever it's rewritten.
+    """
+    st = path.stat()
+    return {"path": str(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+class Manifest:
+    """
+    For each track in an output directory, the fingerprint of everything that
+    went into its contents (audio and lyrics) and its tags, kept separately so
+    that tracks whose tags alone changed can be retagged in place, and the
+    files that were written for it.
+    """
+
+    def __init__(self, dir: Path):
+        self.dir = dir
+        self.path = dir / MANIFEST_NAME
+
+        try:
+            with self.path.open("r") as f:
+                self.old: dict[str, t.Any] = json.load(f)["tracks"]
+        except (OSError, ValueError, KeyError):
+            self.old = {}
+        self.new: dict[str, t.Any] = {}
+        self.claimed: set[str] = set()
+
+    def fresh(self, name: str, fingerprint: str) -> bool:
+        """
+        Whether the outputs for a track are up-to-date with its fingerprint.
+        """
+        entry = self.old.get(name)
+        return (
+            entry is not None
+            and entry["fingerprint"] == fingerprint
+            and all((self.dir / file).exists() for file in entry["files"])
+        )
+
+    def tags_fresh(self, name: str, tags: str) -> bool:
+        """
+        Whether the tags of a track are up-to-date with their fingerprint.
+        """
+        return self.old.get(name, {}).get("tags") == tags
+
+    def find(self, name: str, fingerprint: str, names: set[str]) -> str | None:
+        """
+        The track from before whose outputs have the same contents as this
+        one's would: itself if it's fresh, or else (if it's been renamed) one
+        that's no longer in `names`. Each is only given out once.
+        """
+        if self.fresh(name, fingerprint):
+            self.claimed.add(name)
+            return name
+        for old in self.old:
+            if (
+                old not in names
+                and old not in self.claimed
+                and self.fresh(old, fingerprint)
+            ):
+                self.claimed.add(old)
+                return old
+        return None
+
+    def record(
+        self,
+        name: str,
+        fingerprint: str | None,
+        files: list[str],
+        tags: str | None = None,
+    ) -> None:
+        """
+        Record the outputs of a track. A fingerprint of None means it only
+        partly succeeded, and it'll be redone next time.
+        """
+        self.new[name] = {"fingerprint": fingerprint, "tags": tags, "files": files}
+
+    def keep_all(self) -> None:
+        """
+        Keep every track's entry as it was, for when only some are updated.
+        """
+        self.new = dict(self.old)
+
+    def retagged(self, old: str, name: str, tags: str, files: list[str]) -> None:
+        """
+        Record that a track's tags were rewritten, and its files renamed from
+        those of `old` to `files`, without touching its contents.
+        """
+        entry = self.new.pop(old, None) or self.old.get(old) or {"fingerprint": None}
+        self.new[name] = {**entry, "tags": tags, "files": files}
+
+    def partial(self, name: str, files: list[str]) -> None:
+        """
+        Record that a track only partly succeeded (e.g. its lyrics couldn't
+        be looked up). It'll be redone next time, and until then, whatever
+        else it had before is kept around too.
+        """
+        old = self.old.get(name, {}).get("files", [])
+        self.new[name] = {
+            "fingerprint": None,
+            "files": files + [f for f in old if f not in files],
+        }
+
+    def failed(self, name: str) -> None:
+        """
+        Record that a track failed. Whatever it had before is kept around, but
+        it'll be redone next time.
+        """
+        files = self.old.get(name, {}).get("files", [])
+        self.new[name] = {"fingerprint": None, "files": files}
+
+    def stale(self, name: str) -> list[Path]:
+        """
+        Files that were previously written for a track but aren't any more.
+        """
+        if name not in self.old or name not in self.new:
+            return []
+        files = set(self.new[name]["files"])
+        return [self.dir / f for f in self.old[name]["files"] if f not in files]
+
+    def orphans(self) -> list[Path]:
+        """
+        Files previously written for tracks that no longer exist.
+        """
+        files = {f for entry in self.new.values() for f in entry["files"]}
+        return [
+            self.dir / f
+            for entry in self.old.values()
+            for f in entry["files"]
+            # renamed ones won't be there any more
+            if f not in files and (self.dir / f).exists()
+        ]
+
+    def save(self) -> None:
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        with tmp.open("w") as f:
+            json.dump({"tracks": self.new}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
@@ -2,16 +2,19 @@
 Metadata definitions
 """
 
-from .fetch import fetch_cover
+from .cover import Cover
 import datetime as dt
-import mutagen.id3
-import mutagen.mp3
 import pydantic
 import typing as t
 
 if t.TYPE_CHECKING:
     from .schema import Track
     from .schema import Album
+    import mutagen.id3
+
+
+def sanitise_for_path(s: str):
+    return s.replace("/", "_")
 
 
 class AlbumMeta(pydantic.BaseModel):
@@ -24,6 +27,22 @@ class AlbumMeta(pydantic.BaseModel):
 
     singles: bool = False
 
+    def dirname(self) -> str:
+        """
+        Name of the directory the album is written to.
+        """
+        return sanitise_for_path(
+            self.album_artist if self.singles else f"{self.album_artist} - {self.album}"
+        )
+
+    def filename(self, track: "TrackMeta", index: int) -> str:
+        """
+        Name of the file a track (1-indexed) is written to.
+        """
+        return sanitise_for_path(
+            f"{track.title}.mp3" if self.singles else f"{index:02} - {track.title}.mp3"
+        )
+
 
 class TrackMeta(pydantic.BaseModel):
     model_config = pydantic.ConfigDict(extra="forbid")
@@ -34,50 +53,88 @@ class TrackMeta(pydantic.BaseModel):
 
 
 # TODO this depends too much on the top-level types
-def _generate_tags(
+def _track_frames(
     track: "Track",
     album: "Album",
     index: int,
-) -> t.Iterable[mutagen.id3.Frame]:
+) -> t.Iterable["mutagen.id3.Frame"]:
+    import mutagen.id3
+
     utf8 = mutagen.id3.Encoding.UTF8
 
-    # track tags
     yield mutagen.id3.TIT2(encoding=utf8, text=track.title)
     yield mutagen.id3.TPE1(encoding=utf8, text=track.artists or [album.album_artist])
     if not album.singles:
         yield mutagen.id3.TRCK(encoding=utf8, text=[f"{index}/{len(album.tracks)}"])
 
-    # album tags
+    # fetch
+    yield mutagen.id3.WOAS(url=track.url or album.url)
+
+
+def _cover_frame(url: str, cover: Cover) -> "mutagen.id3.Frame":
+    import mutagen.id3
+
+    return mutagen.id3.APIC(
+        mime=cover.mime,
+        type=mutagen.id3.PictureType.COVER_FRONT,
+        desc=url,
+        data=cover.data,
+    )
+
+
+def album_frames(album: "Album", cover: Cover | None) -> list["mutagen.id3.Frame"]:
+    """
+    The frames that are the same for every track of an album, so they can be
+    built once and shared. `cover` is the album's cover, which is left out if
+    it's None.
+    """
+    import mutagen.id3
+
+    utf8 = mutagen.id3.Encoding.UTF8
+
+    frames: list["mutagen.id3.Frame"] = []
     if not album.singles:
         assert album.album
         assert album.album_artist
         assert album.date
 
-        yield mutagen.id3.TALB(encoding=utf8, text=[album.album])
-        yield mutagen.id3.TPE2(encoding=utf8, text=[album.album_artist])
-        yield mutagen.id3.TYER(encoding=utf8, text=[album.date.strftime("%Y")])
+        frames.append(mutagen.id3.TALB(encoding=utf8, text=[album.album]))
+        frames.append(mutagen.id3.TPE2(encoding=utf8, text=[album.album_artist]))
+        frames.append(mutagen.id3.TYER(encoding=utf8, text=[album.date.strftime("%Y")]))
 
-    # fetch
-    yield mutagen.id3.WOAS(url=track.url or album.url)
-
-    # cover
-    cover_url = track.cover or album.cover
-    if cover_url:
-        cover_mime, cover_data = fetch_cover(cover_url)
-        yield mutagen.id3.APIC(
-            mime=cover_mime,
-            type=mutagen.id3.PictureType.COVER_FRONT,
-            desc=cover_url,
-            data=cover_data,
-        )
+    if album.cover and cover:
+        frames.append(_cover_frame(album.cover, cover))
+    return frames
 
 
 def tag(
     track: "Track",
     album: "Album",
     index: int,
-) -> mutagen.id3.ID3:
+    cover: Cover | None = None,
+    shared: list["mutagen.id3.Frame"] | None = None,
+) -> "mutagen.id3.ID3":
+    """
+    The tags for a track, where `cover` is its cover (its own, or else the
+    album's) and `shared` is `album_frames` for the album, if it's already been
+    built.
+    """
+    import mutagen.id3
+
+    cover_url = track.cover or album.cover
+    if cover_url:
+        assert cover, "cover needs to be fetched first"
+    if shared is None:
+        shared = album_frames(album, None if track.cover else cover)
+
     tags = mutagen.id3.ID3()
-    for frame in _generate_tags(track, album, index):
+    for frame in _track_frames(track, album, index):
         tags.add(frame)
+    for frame in shared:
+        # a track's own cover replaces the album's
+        if not (track.cover and frame.FrameID == "APIC"):
+            tags.add(frame)
+    if track.cover:
+        assert cover
+        tags.add(_cover_frame(track.cover, cover))
     return tags
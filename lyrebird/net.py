@@ -0,0 +1,149 @@
+"""
+Shared HTTP client.
+"""
+
+import asyncio
+import concurrent.futures
+import email.utils
+import functools
+import random
+import time
+import typing as t
+import urllib.parse
+
+if t.TYPE_CHECKING:
+    import requests
+
+USER_AGENT = "lyrebird/0 (https://github.com/ralismark/lyrebird)"
+
+# statuses that are worth trying again
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+
+def _retry_after(r: "requests.Response") -> float | None:
+    """
+    Parse the Retry-After header, which is either seconds or an HTTP date.
+    """
+    value = r.headers.get("retry-after")
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class Client:
+    """
+    An async HTTP client on top of a pooled `requests.Session`.
+
+    Requests to each host are limited to `per_host` at a time, and 429/5xx
+    responses and connection errors are retried with jittered exponential
+    backoff. When a host asks us to back off (via Retry-After), every request
+    to that host waits it out, not just the one that got told.
+    """
+
+    def __init__(
+        self,
+        per_host: int = 4,
+        retries: int = 5,
+        backoff: float = 0.5,
+        max_backoff: float = 60.0,
+        timeout: float = 30.0,
+    ):
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        # requests is blocking, so it gets its own threads rather than
+        # competing with downloads etc. for the default executor
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=4 * per_host, thread_name_prefix="lyrebird-http"
+        )
+        self._slots: dict[tuple[asyncio.AbstractEventLoop, str], asyncio.Semaphore] = {}
+        self._cooldown: dict[str, float] = {}
+
+    @functools.cached_property
+    def session(self) -> "requests.Session":
+        # requests is slow to import, so only do it once we need it
+        import requests.adapters
+
+        session = requests.Session()
+        session.headers["user-agent"] = USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=32, pool_maxsize=self.per_host
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _slot(self, host: str) -> asyncio.Semaphore:
+        key = (asyncio.get_running_loop(), host)
+        if key not in self._slots:
+            self._slots[key] = asyncio.Semaphore(self.per_host)
+        return self._slots[key]
+
+    def _delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    async def get(
+        self,
+        url: str,
+        *,
+        params: t.Mapping[str, t.Any] | None = None,
+        headers: t.Mapping[str, str] | None = None,
+    ) -> "requests.Response":
+        """
+        GET a url. The final response is returned whatever its status, so
+        callers still need to check it.
+        """
+        import requests
+
+        loop = asyncio.get_running_loop()
+        host = urllib.parse.urlsplit(url).netloc
+        request = functools.partial(
+            self.session.get,
+            url,
+            params=params,
+            headers=headers,
+            timeout=self.timeout,
+        )
+
+        attempt = 0
+        while True:
+            if (wait := self._cooldown.get(host, 0) - time.monotonic()) > 0:
+                await asyncio.sleep(wait)
+
+            async with self._slot(host):
+                try:
+                    r = await loop.run_in_executor(self._executor, request)
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt >= self.retries:
+                        raise
+                    r = None
+
+            if r is not None and (
+                r.status_code not in RETRY_STATUS or attempt >= self.retries
+            ):
+                return r
+
+            delay = self._delay(attempt)
+            if r is not None and (retry_after := _retry_after(r)) is not None:
+                delay = max(delay, retry_after)
+                self._cooldown[host] = max(
+                    self._cooldown.get(host, 0), time.monotonic() + delay
+                )
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+HTTP = Client()
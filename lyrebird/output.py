@@ -0,0 +1,285 @@
+"""
+Writing tracks into the output directory.
+
+The audio of a track is the same as what's in the download cache, just with
+different tags, so we try to avoid copying it byte-for-byte. Downloads are
+given room in their tags for any tag we'd write, so on filesystems with
+reflinks, the file is cloned and only the start of its tag is overwritten.
+Otherwise the new tag is written followed by a kernel-side copy of the
+audio, which starts on a block boundary in both files, so that the copy can
+still share storage where the filesystem allows. Either way, each file is
+written once, to a temporary file which is then renamed into place.
+
+Tracks whose audio hasn't changed can also be retagged where they are, in
+which case just their tag is overwritten (see `retag_mp3`).
+"""
+
+from pathlib import Path
+import errno
+import hashlib
+import io
+import os
+import typing as t
+
+if t.TYPE_CHECKING:
+    import mutagen.id3
+
+# linux/fs.h
+FICLONE = 0x40049409
+
+# Padding to leave in tags, so later tags can be written over them in place.
+# Downloads get room for the tags of the outputs cloned from them, which is
+# mostly the cover (see `prepad`).
+PADDING = 64 * 1024
+PREPAD = 1_000_000 + PADDING
+
+# where audio starts is rounded up to this
+BLOCK = 4096
+
+# errors that mean "this way of copying isn't supported here"
+_UNSUPPORTED = frozenset(
+    {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+)
+
+
+def _syncsafe(n: int) -> bytes:
+    return bytes((n >> shift) & 0x7F for shift in (21, 14, 7, 0))
+
+
+def id3_size(f: t.BinaryIO) -> int:
+    """
+    Size of the ID3v2 tag (including header, padding and footer) at the start
+    of a file, or 0 if there isn't one.
+    """
+    f.seek(0)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    size = 0
+    for b in header[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    footer = 10 if header[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def audio_end(f: t.BinaryIO) -> int:
+    """
+    Where the audio in a file ends, excluding any ID3v1 tag.
+    """
+    end = f.seek(0, os.SEEK_END)
+    if end >= 128:
+        f.seek(end - 128)
+        if f.read(3) == b"TAG":
+            return end - 128
+    return end
+
+
+def render(tags: "mutagen.id3.ID3") -> bytes:
+    """
+    Render tags as ID3v2.4, without any padding.
+    """
+    buf = io.BytesIO()
+    tags.save(buf, v1=0, v2_version=4, padding=lambda info: 0)
+    return buf.getvalue()
+
+
+def _describe(frame: "mutagen.id3.Frame") -> str:
+    # binary data (i.e. covers) is summarised rather than included whole
+    data = getattr(frame, "data", None)
+    if isinstance(data, bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        fields = ", ".join(
+            f"{k}={getattr(frame, k)!r}"
+            for k in ("mime", "type", "desc")
+            if hasattr(frame, k)
+        )
+        return f"{type(frame).__name__}({fields}, sha256={digest})"
+    return repr(frame)
+
+
+def frames(tag: bytes) -> dict[str, str]:
+    """
+    Describe each frame in a rendered ID3v2 tag, by its key.
+    """
+    import mutagen.id3
+
+    tags = mutagen.id3.ID3()
+    if tag:
+        tags.load(io.BytesIO(tag), load_v1=False)
+    return {frame.HashKey: _describe(frame) for frame in tags.values()}
+
+
+def pad(tag: bytes, size: int) -> bytes:
+    """
+    Pad a rendered tag to be exactly `size` bytes.
+    """
+    assert size >= len(tag), "tag doesn't fit"
+    # padding is just zeroes after the frames; the header has the size
+    return b"".join([tag[:6], _syncsafe(size - 10), tag[10:], bytes(size - len(tag))])
+
+
+def _copy_range(src: int, dst: int, offset: int, count: int) -> None:
+    """
+    Copy `count` bytes of src starting at `offset` onto the end of dst, doing
+    as much as possible in the kernel.
+    """
+    end = offset + count
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < end:
+                n = os.copy_file_range(src, dst, end - offset, offset_src=offset)
+                if n == 0:
+                    break
+                offset += n
+            return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+
+    if hasattr(os, "sendfile"):
+        try:
+            while offset < end:
+                n = os.sendfile(dst, src, offset, end - offset)
+                if n == 0:
+                    break
+                offset += n
+            return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+
+    while offset < end:
+        chunk = os.pread(src, min(end - offset, 1024 * 1024), offset)
+        if not chunk:
+            break
+        os.write(dst, chunk)
+        offset += len(chunk)
+
+
+def _reflink(src: int, dst: int) -> bool:
+    """
+    Make dst (which should be empty) share all of src's storage, if the
+    filesystem can.
+    """
+    try:
+        import fcntl
+
+        fcntl.ioctl(dst, FICLONE, src)
+    except (ImportError, OSError):
+        return False
+    return True
+
+
+def _aligned(n: int) -> int:
+    return -(-n // BLOCK) * BLOCK
+
+
+def _overwrite(f: t.BinaryIO, tag: bytes, old: bytes) -> None:
+    """
+    Write a rendered tag over the old one at the start of a file, padding it
+    to the same size. Only as much as is needed to cover the old frames is
+    written, since the rest is already zeroes (or a hole, which writing zeroes
+    would fill in).
+    """
+    used = max(len(tag), len(old.rstrip(b"\0")))
+    f.seek(0)
+    f.write(pad(tag, len(old))[:used])
+
+
+def _tmp(path: Path) -> Path:
+    return path.with_name(f".{path.name}.{os.getpid()}.tmp")
+
+
+def write_mp3(src: Path, dst: Path, tags: "mutagen.id3.ID3") -> None:
+    """
+    Write src with its tags replaced by `tags` to dst.
+    """
+    tmp = _tmp(dst)
+    try:
+        with src.open("rb") as s, tmp.open("wb") as d:
+            start = id3_size(s)
+            end = audio_end(s)
+            tag = render(tags)
+
+            if len(tag) <= start and _reflink(s.fileno(), d.fileno()):
+                # fits in the old tag, so share everything and overwrite it
+                os.ftruncate(d.fileno(), end)  # drop any ID3v1 tag
+                s.seek(0)
+                _overwrite(d, tag, s.read(start))
+            else:
+                d.write(pad(tag, _aligned(len(tag) + PADDING)))
+                d.flush()
+                _copy_range(s.fileno(), d.fileno(), start, end - start)
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def retag_mp3(path: Path, tags: "mutagen.id3.ID3") -> bytes | None:
+    """
+    Replace a file's tags with `tags`. If they fit in its current tag, only
+    that is overwritten, in place; otherwise the whole file is rewritten.
+    Returns the old tag, or None if it was already the same.
+    """
+    tag = render(tags)
+    with path.open("r+b") as f:
+        start = id3_size(f)
+        f.seek(0)
+        old = f.read(start)
+        if len(tag) <= start:
+            if pad(tag, start) == old:
+                return None
+            _overwrite(f, tag, old)
+            return old
+
+    write_mp3(path, path, tags)
+    return old
+
+
+def write_bytes(path: Path, data: bytes) -> None:
+    """
+    Write a file atomically.
+    """
+    tmp = _tmp(path)
+    try:
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def prepad(path: Path, room: int = PREPAD) -> None:
+    """
+    Make sure a file has `room` in its tag for tags we'll write later, so
+    that outputs cloned from it can be tagged in place. The padding is left
+    as a hole, so on most filesystems it takes no space.
+    """
+    with path.open("rb") as f:
+        if id3_size(f) >= room:
+            return
+
+    import mutagen.id3
+
+    try:
+        tags = mutagen.id3.ID3(path)
+    except mutagen.id3.ID3NoHeaderError:
+        tags = mutagen.id3.ID3()
+
+    tmp = _tmp(path)
+    try:
+        with path.open("rb") as s, tmp.open("wb") as d:
+            start = id3_size(s)
+            end = audio_end(s)
+            tag = render(tags)
+            size = _aligned(len(tag) + room)
+            # the header says how big it is, but the padding isn't written
+            d.write(pad(tag, size)[: len(tag)])
+            d.seek(size)
+            _copy_range(s.fileno(), d.fileno(), start, end - start)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
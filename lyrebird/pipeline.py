@@ -0,0 +1,336 @@
+"""
+Processing albums: writing out their tracks, covers and lyrics.
+"""
+
+from .cover import Cover
+from .cover import embed_cover
+from .cover import fetch_cover
+from .fetch import Fetched
+from .lrc import Lrc
+from .lrc import LrclibResult
+from .lrc import prefetch
+from .manifest import Manifest
+from .manifest import file_fingerprint
+from .manifest import fingerprint
+from .metadata import album_frames
+from .metadata import tag
+from .output import frames
+from .output import render
+from .output import retag_mp3
+from .output import write_bytes
+from .output import write_mp3
+from .profile import PROFILE
+from .schema import Album
+from .schema import Track
+from pathlib import Path
+import asyncio
+import io
+import mimetypes
+import os
+import rich.console
+import rich.table
+import typing as t
+
+if t.TYPE_CHECKING:
+    import mutagen.id3
+
+
+def buffered(console: rich.console.Console) -> rich.console.Console:
+    """
+    Make a console which holds its output until it is written out with
+    `flush`, so that concurrent jobs don't interleave their output.
+    """
+    return rich.console.Console(
+        file=io.StringIO(),
+        force_terminal=console.is_terminal,
+        color_system=t.cast(t.Any, console.color_system),
+        width=console.width,
+    )
+
+
+def flush(buffer: rich.console.Console, console: rich.console.Console) -> None:
+    assert isinstance(buffer.file, io.StringIO)
+    console.file.write(buffer.file.getvalue())
+    console.file.flush()
+
+
+def profile_table(rows: list[dict[str, t.Any]]) -> rich.table.Table:
+    """
+    Show the summary from `Profiler.summary`.
+    """
+    table = rich.table.Table(title="profile")
+    for column in ["stage", "count", "total", "p50", "p95", "max", "bytes", "hit/miss"]:
+        table.add_column(column, justify="left" if column == "stage" else "right")
+    for row in rows:
+        table.add_row(
+            row["stage"],
+            str(row["count"]),
+            *(f"{row[k]:.3f}s" for k in ["total", "p50", "p95", "max"]),
+            f"{row['bytes'] / 1e6:.1f}MB" if row["bytes"] else "",
+            f"{row['hits']}/{row['misses']}" if row["hits"] or row["misses"] else "",
+        )
+    return table
+
+
+def tags_fingerprint(
+    album: Album, track: Track, index: int, cover: Cover | None
+) -> str:
+    """
+    Fingerprint of everything that goes into a track's tags.
+    """
+    return fingerprint(
+        album.model_dump(mode="json", exclude={"tracks"}),
+        track.model_dump(mode="json"),
+        index,
+        len(album.tracks),
+        cover and cover.digest,
+    )
+
+
+def rename_outputs(src: Path, dst: Path) -> None:
+    """
+    Move a track's files (its mp3, and its .lrc if it has one) to a new name.
+    """
+    os.replace(src, dst)
+    if src.with_suffix(".lrc").exists():
+        os.replace(src.with_suffix(".lrc"), dst.with_suffix(".lrc"))
+
+
+def retag(path: Path, tags: "mutagen.id3.ID3") -> list[str] | None:
+    """
+    Replace a track's tags, in place if possible, giving the frames that
+    changed, or None if nothing did.
+    """
+    old = retag_mp3(path, tags)
+    if old is None:
+        return None
+    have, want = frames(old), frames(render(tags))
+    return sorted(k for k in have.keys() | want.keys() if have.get(k) != want.get(k))
+
+
+async def write_cover(album: Album, outdir: Path, incremental: bool) -> None:
+    """
+    Write the album's cover (as it was fetched, not as it's embedded) next to
+    its tracks.
+    """
+    assert album.cover
+    cover = await fetch_cover(album.cover)
+    ext = mimetypes.guess_extension(cover.mime)
+    assert ext
+    cover_path = outdir / f"cover{ext}"
+    if not (
+        incremental
+        and cover_path.exists()
+        and cover_path.stat().st_size == len(cover.data)
+        and cover_path.read_bytes() == cover.data
+    ):
+        await asyncio.to_thread(write_bytes, cover_path, cover.data)
+
+
+async def process_track(
+    album: Album,
+    track: Track,
+    index: int,
+    fetched: Fetched,
+    album_cover: Cover | None,
+    shared: list["mutagen.id3.Frame"],
+    lrc: Lrc,
+    found: t.Awaitable[LrclibResult | None],
+    outdir: Path,
+    manifest: Manifest,
+    incremental: bool,
+    names: set[str],
+    out: rich.console.Console,
+):
+    path = outdir / album.filename(track, index)
+    out.print(f"===== {path.name}", style="bold yellow")
+    PROFILE.label(track=path.name)
+
+    try:
+        cover = await embed_cover(track.cover) if track.cover else album_cover
+
+        def log(line: str) -> None:
+            out.out(line, highlight=False)
+
+        # a problem with the lyrics shouldn't stop us writing the track
+        try:
+            with PROFILE.span("lyrics") as span:
+                lyrics = await lrc.load(log, found)
+                span["found"] = lyrics is not None
+            lyrics_ok = True
+        except Exception:
+            out.print_exception()
+            lyrics, lyrics_ok = None, False
+
+        fp = fingerprint(file_fingerprint(fetched.path), lyrics)
+        tags_fp = tags_fingerprint(album, track, index, cover)
+        files = [path.name]
+        if lyrics:
+            files.append(path.with_suffix(".lrc").name)
+
+        # if only the tags (or name) changed, the old outputs can be reused
+        old = manifest.find(path.name, fp, names) if incremental else None
+        if old is not None:
+            changed = None
+            if old != path.name:
+                out.print(f"    # renamed from {old}", highlight=False)
+                await asyncio.to_thread(rename_outputs, outdir / old, path)
+            if old != path.name or not manifest.tags_fresh(old, tags_fp):
+                with PROFILE.span("retag"):
+                    tags = tag(track, album, index, cover, shared)
+                    changed = await asyncio.to_thread(retag, path, tags)
+            if changed is None:
+                out.print("    # unchanged", highlight=False)
+            else:
+                out.print(f"    # retagged {' '.join(changed)}", highlight=False)
+            manifest.record(path.name, fp, files, tags_fp)
+            return
+
+        with PROFILE.span("tag"):
+            tags = tag(track, album, index, cover, shared)
+        with PROFILE.span("copy") as span:
+            await asyncio.to_thread(write_mp3, fetched.path, path, tags)
+            span["bytes"] = path.stat().st_size
+
+        if lyrics:
+            await asyncio.to_thread(
+                write_bytes, path.with_suffix(".lrc"), lyrics.encode()
+            )
+
+        if lyrics_ok:
+            manifest.record(path.name, fp, files, tags_fp)
+            for stale in manifest.stale(path.name):
+                stale.unlink(missing_ok=True)
+        else:
+            manifest.partial(path.name, files)
+    except Exception:
+        out.print_exception()
+        manifest.failed(path.name)
+
+
+async def process_album(
+    album: Album,
+    outdir: Path,
+    out: rich.console.Console,
+    incremental: bool = False,
+):
+    manifest = Manifest(outdir)
+    PROFILE.label(album=outdir.name)
+
+    def log(line: str) -> None:
+        out.out(line, highlight=False)
+
+    # fetch album stuff
+    with PROFILE.span("fetch"):
+        fetched = await album.fetch(log)
+    assert len(fetched) == len(album.tracks)
+
+    # Look up everything's lyrics at once, so that they're (hopefully) ready
+    # by the time each track needs them.
+    lrcs = album.lrcs([f.duration for f in fetched])
+    lookups = prefetch(lrcs)
+    try:
+        # normalised once, and shared between all the tracks using it
+        album_cover = await embed_cover(album.cover) if album.cover else None
+        if album.cover:
+            await write_cover(album, outdir, incremental)
+        shared = album_frames(album, album_cover)
+        names = {album.filename(track, i) for i, track in enumerate(album.tracks, 1)}
+
+        # tracks run concurrently, but their output is written out in order
+        buffers = [buffered(out) for _ in album.tracks]
+        tasks = [
+            asyncio.create_task(
+                process_track(
+                    album,
+                    track,
+                    i,
+                    fetched_track,
+                    album_cover,
+                    shared,
+                    lrc,
+                    lookup,
+                    outdir,
+                    manifest,
+                    incremental,
+                    names,
+                    buffer,
+                )
+            )
+            for i, (fetched_track, track, lrc, lookup, buffer) in enumerate(
+                zip(fetched, album.tracks, lrcs, lookups, buffers), start=1
+            )
+        ]
+        for task, buffer in zip(tasks, buffers):
+            await task
+            flush(buffer, out)
+    finally:
+        for lookup in lookups:
+            lookup.cancel()
+        await asyncio.gather(*lookups, return_exceptions=True)
+
+    if incremental:
+        for orphan in manifest.orphans():
+            out.print(f"===== removing {orphan.name}", style="bold red")
+            orphan.unlink(missing_ok=True)
+    manifest.save()
+
+
+async def retag_album(album: Album, outdir: Path, out: rich.console.Console):
+    """
+    Rewrite just the tags (and cover) of an album's existing outputs, for when
+    only its metadata has changed. Nothing is downloaded and no lyrics are
+    looked up, so tracks which aren't there yet are left for a normal run.
+    """
+    manifest = Manifest(outdir)
+    manifest.keep_all()
+    PROFILE.label(album=outdir.name)
+
+    album_cover = await embed_cover(album.cover) if album.cover else None
+    if album.cover:
+        await write_cover(album, outdir, True)
+    shared = album_frames(album, album_cover)
+    names = {album.filename(track, i) for i, track in enumerate(album.tracks, 1)}
+
+    for index, track in enumerate(album.tracks, 1):
+        path = outdir / album.filename(track, index)
+        out.print(f"===== {path.name}", style="bold yellow")
+        PROFILE.label(track=path.name)
+        try:
+            old = path.name
+            if not path.exists():
+                # renamed, which we can only tell by its number
+                renamed = [
+                    name
+                    for name in manifest.old
+                    if not album.singles
+                    and name.startswith(f"{index:02} - ")
+                    and name not in names
+                    and (outdir / name).exists()
+                ]
+                if len(renamed) != 1:
+                    out.print("    # not there, skipping", highlight=False)
+                    continue
+                old = renamed[0]
+                out.print(f"    # renamed from {old}", highlight=False)
+                await asyncio.to_thread(rename_outputs, outdir / old, path)
+
+            cover = await embed_cover(track.cover) if track.cover else album_cover
+            with PROFILE.span("retag"):
+                tags = tag(track, album, index, cover, shared)
+                changed = await asyncio.to_thread(retag, path, tags)
+            if changed is None:
+                out.print("    # unchanged", highlight=False)
+            else:
+                out.print(f"    # retagged {' '.join(changed)}", highlight=False)
+
+            files = [path.name]
+            if path.with_suffix(".lrc").exists():
+                files.append(path.with_suffix(".lrc").name)
+            manifest.retagged(
+                old, path.name, tags_fingerprint(album, track, index, cover), files
+            )
+        except Exception:
+            out.print_exception()
+
+    manifest.save()
@@ -0,0 +1,176 @@
+"""
+Getting the duration of mp3s from their headers alone.
+
+This reads the first MPEG frame and its Xing/Info (with LAME), VBRI header
+or, for CBR files without either, the file size -- the same things mutagen
+uses to get the length, but without parsing the rest of the file. Anything
+unusual falls back to mutagen.
+"""
+
+from pathlib import Path
+import concurrent.futures
+import mmap
+import re
+import typing as t
+
+
+class ProbeError(Exception):
+    pass
+
+
+# kbps, by (version, layer)
+_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_BITRATES[(2, 3)] = _BITRATES[(2, 2)]
+
+_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+
+
+class _Frame(t.NamedTuple):
+    version: float
+    layer: int
+    mono: bool
+    bitrate: int  # bps
+    sample_rate: int
+    samples: int  # per frame
+    length: int  # bytes
+
+
+def _frame(data: t.Any, offset: int) -> _Frame:
+    header = data[offset : offset + 4]
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        raise ProbeError("no frame sync")
+
+    version_bits = (header[1] >> 3) & 0x3
+    layer_bits = (header[1] >> 1) & 0x3
+    bitrate_bits = header[2] >> 4
+    rate_bits = (header[2] >> 2) & 0x3
+    padding = (header[2] >> 1) & 0x1
+    mode = header[3] >> 6
+    if version_bits == 1 or layer_bits == 0 or rate_bits == 3:
+        raise ProbeError("invalid header")
+    if bitrate_bits in (0, 0xF):
+        raise ProbeError("free or invalid bitrate")
+
+    version = [2.5, None, 2, 1][version_bits]
+    assert version is not None
+    layer = 4 - layer_bits
+    bitrate = _BITRATES[(int(version), layer)][bitrate_bits] * 1000
+    sample_rate = _RATES[version][rate_bits]
+
+    if layer == 1:
+        samples, slot = 384, 4
+    elif version >= 2 and layer == 3:
+        samples, slot = 576, 1
+    else:
+        samples, slot = 1152, 1
+    length = ((samples // 8 * bitrate) // sample_rate + padding) * slot
+
+    return _Frame(version, layer, mode == 3, bitrate, sample_rate, samples, length)
+
+
+def _id3_end(data: t.Any) -> int:
+    """
+    Skip over any ID3v2 tags at the start.
+    """
+    offset = 0
+    while data[offset : offset + 3] == b"ID3":
+        header = data[offset : offset + 10]
+        if len(header) < 10:
+            raise ProbeError("truncated ID3 header")
+        size = 0
+        for b in header[6:10]:
+            size = (size << 7) | (b & 0x7F)
+        offset += 10 + size + (10 if header[5] & 0x10 else 0)
+    return offset
+
+
+def _lame_delay(data: t.Any, offset: int) -> int:
+    """
+    Encoder delay + padding from a LAME header, or 0 if there isn't one.
+    """
+    version = bytes(data[offset : offset + 20])
+    if not version.startswith((b"LAME", b"L3.99")):
+        return 0
+    # the extended header (which has these) was added in 3.90
+    m = re.match(rb"[LAME]*(\d)\.*(\d+)", version)
+    if not m or (int(m[1]), int(m[2])) < (3, 90):
+        return 0
+
+    # delay and padding are 12 bits each, 21 bytes in
+    packed = data[offset + 21 : offset + 24]
+    if len(packed) < 3:
+        return 0
+    delay = (packed[0] << 4) | (packed[1] >> 4)
+    padding = ((packed[1] & 0xF) << 8) | packed[2]
+    return delay + padding
+
+
+def _duration(data: t.Any) -> float:
+    offset = _id3_end(data)
+    frame = _frame(data, offset)
+
+    if frame.layer == 3:
+        # Xing/Info
+        if frame.version == 1:
+            xing = offset + (21 if frame.mono else 36)
+        else:
+            xing = offset + (13 if frame.mono else 21)
+        if data[xing : xing + 4] in (b"Xing", b"Info"):
+            flags = int.from_bytes(data[xing + 4 : xing + 8], "big")
+            pos = xing + 8
+            frames = -1
+            if flags & 0x1:
+                frames = int.from_bytes(data[pos : pos + 4], "big")
+                pos += 4
+            pos += 4 * bool(flags & 0x2) + 100 * bool(flags & 0x4)
+            pos += 4 * bool(flags & 0x8)
+            if frames == -1:
+                raise ProbeError("Xing header without frame count")
+
+            samples = frame.samples * frames - _lame_delay(data, pos)
+            return max(samples, 0) / frame.sample_rate
+
+        # VBRI
+        vbri = offset + 36
+        if data[vbri : vbri + 4] == b"VBRI":
+            frames = int.from_bytes(data[vbri + 14 : vbri + 18], "big")
+            return frame.samples * frames / frame.sample_rate
+
+    # CBR: estimate from the size, but first make sure we've actually found
+    # the audio by checking there's another frame after this one
+    _frame(data, offset + frame.length)
+    return 8 * (len(data) - offset) / frame.bitrate
+
+
+def probe(path: Path) -> float:
+    """
+    Duration of an mp3, in seconds.
+    """
+    try:
+        with path.open("rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            return _duration(data)
+    except (ProbeError, ValueError, IndexError):
+        pass
+
+    import mutagen.mp3
+
+    mp3 = mutagen.mp3.MP3(path)
+    assert mp3.info
+    return mp3.info.length
+
+
+def probe_all(paths: t.Iterable[Path]) -> list[float]:
+    """
+    Durations of a batch of mp3s, probed concurrently, since on a network
+    filesystem it's mostly waiting.
+    """
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        return list(pool.map(probe, paths))
@@ -0,0 +1,136 @@
+"""
+Timing the stages of the pipeline.
+
+Each stage (downloading, probing, fetching covers and lyrics, tagging,
+copying, ...) is recorded as a span with its duration and whatever else is
+worth knowing, like how many bytes it handled or whether it hit the cache.
+Spans pick up which album and track they're for from the context they run
+in, so they can be broken down that way later.
+
+Nothing is recorded unless profiling is turned on, in which case the spans
+can be written out as JSON lines, or in Chrome's trace format (for
+chrome://tracing or Perfetto).
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import statistics
+import threading
+import time
+import typing as t
+
+# what we're currently working on, e.g. {"album": ..., "track": ...}
+_LABELS: contextvars.ContextVar[dict[str, t.Any]] = contextvars.ContextVar(
+    "labels", default={}
+)
+
+
+class Span(t.NamedTuple):
+    stage: str
+    start: int  # ns, from perf_counter_ns
+    end: int
+    thread: int
+    attrs: dict[str, t.Any]
+
+    @property
+    def seconds(self) -> float:
+        return (self.end - self.start) / 1e9
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+        self._epoch = time.perf_counter_ns()
+
+    def label(self, **labels: t.Any) -> None:
+        """
+        Label every span started from now on in the current context, i.e. the
+        current task, and tasks and threads started from it.
+        """
+        _LABELS.set(_LABELS.get() | labels)
+
+    @contextlib.contextmanager
+    def span(self, stage: str, **attrs: t.Any) -> t.Iterator[dict[str, t.Any]]:
+        """
+        Time a stage. The dict given can be filled in with more details
+        (bytes, cache hit/miss, ...) as they become known.
+        """
+        attrs = _LABELS.get() | attrs
+        if not self.enabled:
+            yield attrs
+            return
+
+        start = time.perf_counter_ns()
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs["error"] = type(e).__name__
+            raise
+        finally:
+            span = Span(
+                stage, start, time.perf_counter_ns(), threading.get_ident(), attrs
+            )
+            with self._lock:
+                self.spans.append(span)
+
+    def write_jsonl(self, f: t.TextIO) -> None:
+        for span in self.spans:
+            record = {
+                "stage": span.stage,
+                "start": (span.start - self._epoch) / 1e9,
+                "seconds": span.seconds,
+                **span.attrs,
+            }
+            f.write(json.dumps(record, default=str) + "\n")
+
+    def write_chrome(self, f: t.TextIO) -> None:
+        events = [
+            {
+                "name": span.stage,
+                "cat": span.stage,
+                "ph": "X",
+                "ts": (span.start - self._epoch) / 1e3,
+                "dur": (span.end - span.start) / 1e3,
+                "pid": os.getpid(),
+                "tid": span.thread,
+                "args": span.attrs,
+            }
+            for span in self.spans
+        ]
+        json.dump({"traceEvents": events}, f, default=str)
+
+    def summary(self) -> list[dict[str, t.Any]]:
+        """
+        Totals for each stage.
+        """
+        stages: dict[str, list[Span]] = {}
+        for span in self.spans:
+            stages.setdefault(span.stage, []).append(span)
+
+        rows = []
+        for stage, spans in stages.items():
+            times = sorted(s.seconds for s in spans)
+            caches = [s.attrs["cache"] for s in spans if "cache" in s.attrs]
+            rows.append(
+                {
+                    "stage": stage,
+                    "count": len(spans),
+                    "total": sum(times),
+                    "p50": statistics.median(times),
+                    "p95": times[min(len(times) - 1, int(0.95 * len(times)))],
+                    "max": times[-1],
+                    "bytes": sum(s.attrs.get("bytes", 0) for s in spans),
+                    "hits": caches.count("hit"),
+                    "misses": len(caches) - caches.count("hit"),
+                    "errors": sum("error" in s.attrs for s in spans),
+                }
+            )
+        rows.sort(key=lambda r: r["total"], reverse=True)
+        return rows
+
+
+PROFILE = Profiler()
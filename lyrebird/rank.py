@@ -0,0 +1,113 @@
+"""
+Ranking lrclib.net search results by how well they match a track.
+
+Candidates are scored on how similar their track, artist and album names are
+to what we searched for, as well as how close their duration is. Anything
+too far off in duration (which `Lrc.load` would reject anyway) is ranked
+after everything that isn't.
+"""
+
+import difflib
+import functools
+import re
+import typing as t
+import unicodedata
+
+# weights of each part of the score
+W_TRACK = 0.5
+W_ARTIST = 0.25
+W_ALBUM = 0.1
+W_DURATION = 0.15
+
+# things that are often tacked onto titles, which say little about whether
+# it's the same song
+_RE_EXTRA = re.compile(
+    r"\s[(\[][^)\]]*\b(?:feat|ft|with|remaster(?:ed)?|version|edit|mix)\b[^)\]]*[)\]]"
+    r"|\s-\s.*\b(?:remaster(?:ed)?|version|edit|mix)\b.*$",
+    re.IGNORECASE,
+)
+_RE_PUNCT = re.compile(r"[^\w\s]+")
+_RE_ARTIST_SEP = re.compile(
+    r"\s*(?:,|&|\+|/|;|\bx\b|\band\b|\bfeat\.?|\bft\.?|\bwith\b)\s*"
+)
+
+
+class Query(t.NamedTuple):
+    track: str
+    artist: str  # possibly several, joined with ", "
+    album: str
+    duration: float
+
+
+@functools.lru_cache(maxsize=4096)
+def normalise(s: str) -> str:
+    """
+    Reduce a title to something comparable: no case, accents, punctuation or
+    version suffixes.
+    """
+    s = _RE_EXTRA.sub("", s)
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    return " ".join(_RE_PUNCT.sub(" ", s.casefold()).split())
+
+
+@functools.lru_cache(maxsize=4096)
+def _artists(s: str) -> frozenset[str]:
+    parts = (normalise(p) for p in _RE_ARTIST_SEP.split(s.casefold()))
+    return frozenset(p for p in parts if p)
+
+
+@functools.lru_cache(maxsize=16384)
+def similarity(a: str, b: str) -> float:
+    """
+    How alike two (normalised) strings are, from 0 to 1.
+    """
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    # word overlap handles reordering, the sequence ratio handles typos
+    wa, wb = set(a.split()), set(b.split())
+    words = len(wa & wb) / len(wa | wb)
+    m = difflib.SequenceMatcher(None, a, b)
+    if m.real_quick_ratio() <= words or m.quick_ratio() <= words:
+        return words  # the ratio (which is slow) can't be any better
+    return max(words, m.ratio())
+
+
+def artist_similarity(a: str, b: str) -> float:
+    """
+    How alike two lists of artists are, allowing for them being in a
+    different order, or one only having some of them.
+    """
+    xs, ys = _artists(a), _artists(b)
+    if not xs or not ys:
+        return 0.0
+    small, large = sorted((xs, ys), key=len)
+    return sum(max(similarity(x, y) for y in large) for x in small) / len(small)
+
+
+def score(query: Query, result: dict[str, t.Any], slop: float) -> float:
+    """
+    How well a search result matches, from 0 to 1, or below 0 if its duration
+    is more than `slop` off.
+    """
+    diff = abs(result["duration"] - query.duration)
+    s = (
+        W_TRACK * similarity(normalise(query.track), normalise(result["trackName"]))
+        + W_ARTIST * artist_similarity(query.artist, result["artistName"])
+        + W_ALBUM * similarity(normalise(query.album), normalise(result["albumName"]))
+        + W_DURATION * max(0.0, 1 - diff / (2 * slop))
+    )
+    return s if diff <= slop else s - 1
+
+
+def rank(
+    query: Query, results: t.Iterable[dict[str, t.Any]], slop: float
+) -> list[tuple[float, dict[str, t.Any]]]:
+    """
+    Search results (as returned by lrclib.net) and their scores, best first.
+    """
+    scored = [(score(query, r, slop), r) for r in results]
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return scored
@@ -8,6 +8,7 @@ from .lrc import Lrc
 from .metadata import AlbumMeta
 from .metadata import TrackMeta
 import pydantic
+import typing as t
 
 
 class Track(TrackMeta, TrackFetch):
@@ -29,3 +30,15 @@ class Album(AlbumMeta, AlbumFetch):
 
     lrc: Lrc = Lrc()
     tracks: tuple[Track, ...]
+
+    def lrcs(self, durations: t.Sequence[float]) -> tuple[Lrc, ...]:
+        """
+        The lyrics config for each track, given their durations: the album's
+        (unless it's a collection of singles), then the track's own, on top of
+        the defaults.
+        """
+        base = Lrc() if self.singles else self.lrc
+        return tuple(
+            Lrc.from_track(track, self, duration, base, track.lrc)
+            for track, duration in zip(self.tracks, durations, strict=True)
+        )
@@ -0,0 +1,90 @@
+"""
+A cache of validated specs, so that they're only parsed again if they change.
+
+Each spec's entry records the file's size, mtime and hash, as well as a hash
+of the schema, with the validated album stored as JSON (which pydantic can
+load much faster than PyYAML can parse yaml). An entry is used as long as the
+file has the same size and mtime, or failing that, the same contents.
+"""
+
+from .fetch import CACHEDIR
+from .schema import Album
+from pathlib import Path
+import functools
+import hashlib
+import json
+import os
+
+SPEC_CACHE_DIR = CACHEDIR / "specs"
+
+# bumped whenever entries are stored differently
+FORMAT = 2
+
+
+@functools.cache
+def _schema() -> str:
+    """
+    Something that changes whenever the schema does, so old entries aren't
+    used for a different schema.
+    """
+    schema = json.dumps(Album.model_json_schema(), sort_keys=True)
+    return hashlib.sha256(f"{FORMAT}:{schema}".encode()).hexdigest()
+
+
+def parse_spec(data: bytes) -> Album:
+    import yaml
+
+    # the C loader is several times faster, if it's there
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    return Album(**yaml.load(data, Loader=loader))
+
+
+def load_spec(path: Path) -> Album:
+    """
+    Load and validate a spec, reusing the last result if it hasn't changed.
+    """
+    st = path.stat()
+    key = hashlib.sha256(str(path.resolve()).encode()).hexdigest()
+    entry_path = SPEC_CACHE_DIR / f"{key}.json"
+
+    # the first line is the header, and the rest is the album
+    header = None
+    cached = b""
+    try:
+        with entry_path.open("rb") as f:
+            header = json.loads(f.readline())
+            if header["schema"] != _schema():
+                header = None
+            elif header["size"] == st.st_size and header["mtime_ns"] == st.st_mtime_ns:
+                return Album.model_validate_json(f.read())
+            else:
+                cached = f.read()
+    except (OSError, ValueError, KeyError):
+        header = None
+
+    data = path.read_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    if header is not None and header["sha256"] == digest:
+        # only touched, not changed
+        album = Album.model_validate_json(cached)
+    else:
+        album = parse_spec(data)
+        # Only what was actually given, since which fields were set matters
+        # for merging lyrics configs.
+        cached = album.model_dump_json(exclude_unset=True).encode()
+
+    header = {
+        "schema": _schema(),
+        "size": len(data),
+        "mtime_ns": st.st_mtime_ns,
+        "sha256": digest,
+    }
+    try:
+        SPEC_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = entry_path.with_name(f"{entry_path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(json.dumps(header).encode() + b"\n" + cached)
+        os.replace(tmp, entry_path)
+    except OSError:
+        pass  # it's only a cache
+
+    return album
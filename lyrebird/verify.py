@@ -0,0 +1,263 @@
+"""
+Checking that an output library still matches its specs, without rebuilding
+it.
+
+    lyrebird verify SPEC... [-o OUT] [-j N]
+
+Each track's tags are read from its ID3v2 header alone (never the audio), and
+compared frame by frame with what `metadata.tag` would write; its .lrc is
+compared with what its `Lrc` would give. Everything that doesn't match is
+reported as JSON.
+
+Checking is done on a pool of workers. Tracks whose files haven't changed
+(going by their size and mtime) since they last matched, with the same spec,
+cover and lyrics, aren't read again.
+"""
+
+from .cover import embed_cover
+from .fetch import CACHEDIR
+from .lrc import prefetch
+from .manifest import fingerprint
+from .metadata import tag
+from .output import frames
+from .output import id3_size
+from .output import render
+from .probe import probe
+from .schema import Album
+from .speccache import load_spec
+from pathlib import Path
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import sys
+import typing as t
+
+if t.TYPE_CHECKING:
+    import mutagen.id3
+
+VERIFY_CACHE_DIR = CACHEDIR / "verify"
+
+Drift = dict[str, t.Any]
+
+
+def _stat(path: Path) -> list[int] | None:
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def read_tag(path: Path) -> bytes:
+    """
+    Read just the ID3v2 tag at the start of a file.
+    """
+    with path.open("rb") as f:
+        size = id3_size(f)
+        f.seek(0)
+        return f.read(size)
+
+
+def check_files(
+    path: Path,
+    expected: t.Callable[[], "mutagen.id3.ID3"],
+    lyrics: str | None,
+    lyrics_ok: bool = True,
+) -> list[Drift]:
+    """
+    Compare a track's tags and lyrics on disk with what they should be. If the
+    lyrics couldn't be looked up (not lyrics_ok), only the tags are checked.
+    """
+    drift: list[Drift] = []
+
+    # rendered and read back, so they go through the same conversions (e.g.
+    # to ID3v2.4) as the file's did
+    want = frames(render(expected()))
+    have = frames(read_tag(path))
+    diff = [
+        {"frame": key, "expected": want.get(key), "actual": have.get(key)}
+        for key in sorted(want.keys() | have.keys())
+        if want.get(key) != have.get(key)
+    ]
+    if diff:
+        drift.append({"path": str(path), "issue": "tags", "frames": diff})
+    if not lyrics_ok:
+        return drift
+
+    lrc_path = path.with_suffix(".lrc")
+    try:
+        actual = lrc_path.read_bytes().decode()
+    except FileNotFoundError:
+        actual = None
+    if lyrics is None and actual is not None:
+        drift.append({"path": str(lrc_path), "issue": "unexpected"})
+    elif lyrics is not None and actual is None:
+        drift.append({"path": str(lrc_path), "issue": "missing"})
+    elif lyrics != actual:
+        drift.append({"path": str(lrc_path), "issue": "lyrics"})
+
+    return drift
+
+
+class Verifier:
+    """
+    Checks albums against their outputs, recording what's drifted.
+    """
+
+    def __init__(self, pool: concurrent.futures.Executor):
+        self.pool = pool
+        self.drift: list[Drift] = []
+        self.tracks = 0
+        self.skipped = 0
+
+    async def album(self, album: Album, dir: Path) -> None:
+        if not dir.is_dir():
+            self.drift.append({"path": str(dir), "issue": "missing"})
+            return
+
+        key = hashlib.sha256(str(dir.resolve()).encode()).hexdigest()
+        cache_path = VERIFY_CACHE_DIR / f"{key}.json"
+        try:
+            with cache_path.open("r") as f:
+                old: dict[str, t.Any] = json.load(f)
+        except (OSError, ValueError):
+            old = {}
+        new: dict[str, t.Any] = {}
+
+        loop = asyncio.get_running_loop()
+        names = [album.filename(track, i) for i, track in enumerate(album.tracks, 1)]
+        stats = [_stat(dir / name) for name in names]
+
+        async def duration(name: str, stat: list[int] | None) -> float:
+            if stat is None:
+                return 0.0
+            entry = old.get(name)
+            if entry and entry["mp3"] == stat:
+                return entry["duration"]
+            # the same audio as was downloaded, so the same duration
+            return await loop.run_in_executor(self.pool, probe, dir / name)
+
+        durations = await asyncio.gather(*map(duration, names, stats))
+        lrcs = album.lrcs(durations)
+        present = [i for i, stat in enumerate(stats) if stat is not None]
+        lookups = dict(zip(present, prefetch(lrcs[i] for i in present)))
+
+        async def track(i: int) -> None:
+            track = album.tracks[i]
+            path = dir / names[i]
+            cover = await embed_cover(track.cover) if track.cover else album_cover
+
+            try:
+                lyrics = await lrcs[i].load(lambda _: None, lookups[i])
+                lyrics_ok = True
+            except Exception as e:
+                self.drift.append(
+                    {"path": str(path), "issue": "error", "error": str(e)}
+                )
+                lyrics, lyrics_ok = None, False
+
+            entry = {
+                "mp3": stats[i],
+                "lrc": _stat(path.with_suffix(".lrc")),
+                "duration": durations[i],
+                "fingerprint": fingerprint(
+                    album.model_dump(mode="json", exclude={"tracks"}),
+                    track.model_dump(mode="json"),
+                    i + 1,
+                    len(album.tracks),
+                    cover and cover.digest,
+                    lyrics,
+                ),
+            }
+            self.tracks += 1
+            if old.get(names[i]) == entry:
+                self.skipped += 1
+                new[names[i]] = entry
+                return
+
+            drift = await loop.run_in_executor(
+                self.pool,
+                check_files,
+                path,
+                functools.partial(tag, track, album, i + 1, cover),
+                lyrics,
+                lyrics_ok,
+            )
+            self.drift.extend(drift)
+            if lyrics_ok and not drift:
+                new[names[i]] = entry
+
+        try:
+            album_cover = await embed_cover(album.cover) if album.cover else None
+            for i, stat in enumerate(stats):
+                if stat is None:
+                    self.drift.append({"path": str(dir / names[i]), "issue": "missing"})
+            await asyncio.gather(*map(track, present))
+        finally:
+            for lookup in lookups.values():
+                lookup.cancel()
+            await asyncio.gather(*lookups.values(), return_exceptions=True)
+
+        # anything we wouldn't have written
+        expected = {*names, *(Path(name).with_suffix(".lrc").name for name in names)}
+        for path in sorted(dir.iterdir()):
+            if path.suffix in (".mp3", ".lrc") and path.name not in expected:
+                self.drift.append({"path": str(path), "issue": "orphan"})
+
+        VERIFY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        with tmp.open("w") as f:
+            json.dump(new, f)
+        os.replace(tmp, cache_path)
+
+
+async def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog="lyrebird verify")
+    parser.add_argument("spec", nargs="+", type=Path)
+    parser.add_argument("--out", "-o", type=Path, default=Path.cwd())
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of files to check at once",
+    )
+    args = parser.parse_args(argv)
+
+    albums: list[Album] = []
+    for spec in args.spec:
+        try:
+            albums.append(load_spec(spec))
+        except Exception as e:
+            parser.error(f"not valid: {spec}\n{e}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        verifier = Verifier(pool)
+        slots = asyncio.Semaphore(args.jobs)
+
+        async def run(spec: Path, album: Album) -> None:
+            async with slots:
+                try:
+                    await verifier.album(album, args.out / album.dirname())
+                except Exception as e:
+                    verifier.drift.append(
+                        {"path": str(spec), "issue": "error", "error": repr(e)}
+                    )
+
+        await asyncio.gather(*map(run, args.spec, albums))
+
+    json.dump(
+        {
+            "tracks": verifier.tracks,
+            "skipped": verifier.skipped,
+            "drift": verifier.drift,
+        },
+        sys.stdout,
+        indent=1,
+    )
+    print()
+    return 1 if verifier.drift else 0
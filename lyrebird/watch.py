@@ -0,0 +1,148 @@
+"""
+Watching spec directories for changes.
+
+This uses inotify (through libc, so there's nothing extra to install) where
+it's available, and otherwise falls back to polling. Editors tend to save in
+several steps, and specs are often saved a few at a time, so changes are
+collected until things have been quiet for a moment, and then given all at
+once.
+"""
+
+from pathlib import Path
+import asyncio
+import contextlib
+import ctypes
+import ctypes.util
+import os
+import struct
+import typing as t
+
+# linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len (then the name)
+
+SUFFIX = ".yaml"
+
+
+class Inotify:
+    """
+    Files written or moved into some directories, via inotify.
+    """
+
+    def __init__(self, dirs: t.Iterable[Path]):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify isn't supported here")
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.dirs: dict[int, Path] = {}
+        try:
+            for dir in dirs:
+                wd = libc.inotify_add_watch(
+                    self.fd, os.fsencode(dir), IN_CLOSE_WRITE | IN_MOVED_TO
+                )
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), f"can't watch {dir}")
+                self.dirs[wd] = dir
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def read(self) -> list[Path]:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, _, _, size = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset : offset + size].rstrip(b"\0")
+            offset += size
+            if wd in self.dirs and name:
+                paths.append(self.dirs[wd] / os.fsdecode(name))
+        return paths
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+async def _poll(
+    dirs: list[Path], queue: asyncio.Queue[Path], interval: float
+) -> t.NoReturn:
+    """
+    Watch by checking the size and mtime of everything every so often.
+    """
+
+    def scan() -> dict[Path, tuple[int, int]]:
+        stats = {}
+        for dir in dirs:
+            for path in dir.glob(f"*{SUFFIX}"):
+                with contextlib.suppress(OSError):
+                    st = path.stat()
+                    stats[path] = st.st_size, st.st_mtime_ns
+        return stats
+
+    old = await asyncio.to_thread(scan)
+    while True:
+        await asyncio.sleep(interval)
+        new = await asyncio.to_thread(scan)
+        for path, stat in new.items():
+            if old.get(path) != stat:
+                queue.put_nowait(path)
+        old = new
+
+
+async def watch(
+    dirs: t.Iterable[Path],
+    debounce: float = 0.5,
+    poll: float = 1.0,
+) -> t.AsyncIterator[set[Path]]:
+    """
+    Yield the specs in some directories that have changed, in batches once
+    there have been no more changes for `debounce` seconds.
+    """
+    dirs = list(dirs)
+    queue: asyncio.Queue[Path] = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+
+    def read(inotify: Inotify) -> None:
+        for path in inotify.read():
+            queue.put_nowait(path)
+
+    inotify: Inotify | None
+    poller: asyncio.Task[t.NoReturn] | None = None
+    try:
+        inotify = Inotify(dirs)
+    except OSError:
+        inotify = None
+        poller = asyncio.create_task(_poll(dirs, queue, poll))
+    else:
+        loop.add_reader(inotify.fd, read, inotify)
+
+    try:
+        while True:
+            changed = {await queue.get()}
+            while True:
+                try:
+                    changed.add(await asyncio.wait_for(queue.get(), debounce))
+                except TimeoutError:
+                    break
+            # ignore editors' swap and backup files
+            specs = {p for p in changed if p.suffix == SUFFIX}
+            if specs:
+                yield specs
+    finally:
+        if inotify is not None:
+            loop.remove_reader(inotify.fd)
+            inotify.close()
+        if poller is not None:
+            poller.cancel()